@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import argparse
+import math
+import numpy as np
 import pygame as py
 import pygame.gfxdraw
+from time import perf_counter
 from game import TetrisGame as tgame 
 from pieces import TetrisPiece as tpiece
+from profiler import Profiler
+from sim_clock import SimulationClock
+from text_cache import TextCache
 
 class TetrisUI(object):
     '''
@@ -65,8 +72,49 @@ class TetrisUI(object):
     BTN_TOP_LEFT_X          = (SCREEN_WIDTH / 2) - (BTN_WIDTH / 2)
     BTN_TOP_LEFT_Y          = (SCREEN_HEIGHT / 2) - (BTN_HEIGHT / 2) + BTN_OFFSET_Y
 
-    def __init__(self):
-        self.game_logic = tgame(num_of_rows=self.NUM_OF_SQUARES_ROWS, num_of_columns=self.NUM_OF_SQUARES_COLUMS)
+    MENU_WIDTH              = 300
+    MENU_HEIGHT             = 200
+
+    # Game data boxes:
+    DATA_BOX_WIDTH          = 220
+    DATA_BOX_HEIGHT         = 200
+    DATA_BOX_TOP_OFF_SET    = 100
+    DATA_TITLE_HEIGHT       = 50
+
+    # Marks a square of the playing field that shows the ghost piece.
+    SQUARE_GHOST            = -1
+
+    # Transparent color of the pre-rendered grid and border layers.
+    COLOR_KEY               = (255, 0, 255)
+
+    # Loop scheduling. The game logic runs on a fixed timestep, frames are
+    # only rendered when something changed and at most FPS times a second.
+    LOGIC_TICKS_PER_SEC     = 60
+    FPS                     = 60
+    # Logic ticks further behind than this are dropped, e.g. after the
+    # window was dragged.
+    MAX_LOGIC_LAG_SEC       = 0.25
+
+    KEY_ACTIONS             = {py.K_SPACE: tgame.ACTION_HARD_DROP,
+                               py.K_DOWN: tgame.ACTION_DOWN,
+                               py.K_LEFT: tgame.ACTION_LEFT,
+                               py.K_RIGHT: tgame.ACTION_RIGHT,
+                               py.K_UP: tgame.ACTION_ROTATE_CW}
+
+    # Profiler overlay, toggled with F3 when a Profiler is handed in.
+    PROFILED_METHODS        = ('handle_event', 'update_logic', 'draw_background', 'draw_playing_field', 
+                               'draw_game_data', 'draw_start_menu', 'draw_game_over_menu', 'update_display')
+    KEY_PROFILER_OVERLAY    = py.K_F3
+    FONT_SIZE_OVERLAY       = 14
+    PROFILER_OVERLAY_RECT   = (10, 330, 305, 400)
+    # x offset of the phase, p50, p95 and p99 columns.
+    PROFILER_OVERLAY_COLUMNS = (8, 165, 210, 255)
+    PROFILER_OVERLAY_LINE_HEIGHT = 18
+    PROFILER_OVERLAY_UPDATE_SEC = 0.5
+
+    def __init__(self, profiler=None, profiler_output=None):
+        self.game_logic = tgame(num_of_rows=self.NUM_OF_SQUARES_ROWS, num_of_columns=self.NUM_OF_SQUARES_COLUMS, 
+                                clock=SimulationClock(self.LOGIC_TICKS_PER_SEC), profiler=profiler)
         self.new_game = True
 
         # Initialize PyGame:
@@ -74,8 +122,33 @@ class TetrisUI(object):
         py.display.set_caption("Tetris")
         self.screen = py.display
         self.screen_surface = self.screen.set_mode((self.SCREEN_WIDTH, self.SCREEN_HEIGHT))
-        self.clock = py.time.Clock()
-        self.fps = 25
+        self.fps = self.FPS
+        self.next_logic_tick = 0
+        self.last_render = 0
+        self.state_changed = True
+        self.text_cache = TextCache()
+
+        # Dirty rect rendering: what every square of the playing field looked
+        # like when it was last drawn, the game data last drawn and the
+        # rects changed since the last display update.
+        self.drawn_squares = None
+        self.drawn_game_data = None
+        self.game_over_menu_drawn = False
+        self.dirty_rects = []
+        self.full_redraw = True
+
+        # Pre-rendered static layers and sprites, see build_layers().
+        self.layers_key = None
+        self.build_layers()
+
+        # Optional timing of the game and UI phases, written to
+        # profiler_output (CSV, or JSON by extension) on exit.
+        self.profiler = profiler
+        self.profiler_output = profiler_output
+        self.show_profiler_overlay = False
+        self.profiler_overlay_drawn = None
+        if profiler:
+            profiler.instrument(self, self.PROFILED_METHODS)
 
     def init_game(self):
         self.game_logic.setup_new_game()
@@ -86,64 +159,134 @@ class TetrisUI(object):
         self.draw_playing_field()
         self.draw_game_data()
 
+    def build_layers(self):
+        # Renders everything static once. Frames are then composed by
+        # blitting these, and they are rebuilt if the window or the square
+        # size changes.
+        layers_key = (self.screen_surface.get_size(), self.SIZE_OF_SQUARE)
+        if layers_key == self.layers_key:
+            return
+        self.layers_key = layers_key
+        screen_size = self.screen_surface.get_size()
+
+        self.tile_sprites = []
+        for color in self.COLOR_PIECE_ALL:
+            sprite = py.Surface((self.SIZE_OF_SQUARE, self.SIZE_OF_SQUARE))
+            sprite.fill(color)
+            self.tile_sprites.append(sprite)
+
+        self.ghost_sprite = self.create_color_key_layer((self.SIZE_OF_SQUARE, self.SIZE_OF_SQUARE))
+        py.draw.rect(self.ghost_sprite, self.COLOR_GHOST_PIECE_LINE, 
+                     (0, 0, self.SIZE_OF_SQUARE, self.SIZE_OF_SQUARE), self.LINE_WIDTH_4)
+
+        self.grid_layer = self.create_color_key_layer(screen_size)
+        self.draw_playing_grid(self.grid_layer)
+        self.border_layer = self.create_color_key_layer(screen_size)
+        self.draw_border_on_playing_area(self.border_layer)
+
+        self.background_layer = py.Surface(screen_size)
+        self.background_layer.fill(self.COLOR_BACKGROUND)
+        self.background_layer.fill(self.COLOR_PIECE_EMPTY, self.get_squares_rect())
+        self.background_layer.blit(self.grid_layer, (0, 0))
+        self.background_layer.blit(self.border_layer, (0, 0))
+
+        self.menu_layers = {}
+        for menu_text, btn_text in (("NEW GAME", "START"), ("GAME OVER", "NEW GAME")):
+            def draw_menu(surface):
+                self.draw_default_start_and_end_game_rect(surface)
+                self.draw_menu_text(menu_text, btn_text, surface)
+            self.menu_layers[menu_text] = self.create_alpha_layer(screen_size, self.get_menu_rect(), draw_menu)
+
+    def create_color_key_layer(self, size):
+        layer = py.Surface(size)
+        layer.fill(self.COLOR_KEY)
+        layer.set_colorkey(self.COLOR_KEY)
+        return layer
+
+    def create_alpha_layer(self, size, rect, draw):
+        # gfxdraw does not antialias onto transparent pixels properly, so the
+        # layer is drawn on black and on white and the alpha of every pixel
+        # is recovered from the difference. Only rect is kept.
+        on_black = py.Surface(size)
+        on_black.fill((0, 0, 0))
+        draw(on_black)
+        on_white = py.Surface(size)
+        on_white.fill((255, 255, 255))
+        draw(on_white)
+
+        black = py.surfarray.array3d(on_black.subsurface(rect)).astype(np.int32)
+        white = py.surfarray.array3d(on_white.subsurface(rect)).astype(np.int32)
+        alpha = 255 - (white - black).max(axis=2)
+        layer = py.Surface(rect.size, py.SRCALPHA)
+        py.surfarray.pixels3d(layer)[...] = np.minimum(black * 255 // np.maximum(alpha, 1)[..., None], 255)
+        py.surfarray.pixels_alpha(layer)[...] = alpha
+        return layer
+
+    def draw_menu(self, menu_text):
+        rect = self.get_menu_rect()
+        self.screen_surface.blit(self.menu_layers[menu_text], rect)
+        self.dirty_rects.append(rect)
+
     def draw_start_menu(self):
-        self.draw_default_start_and_end_game_rect()
-        self.draw_menu_text("NEW GAME", "START")
+        self.draw_menu("NEW GAME")
     
     def draw_game_over_menu(self):
-        self.draw_default_start_and_end_game_rect()
-        self.draw_menu_text("GAME OVER", "NEW GAME")
-
-    def draw_menu_text(self, menu_text, btn_text):
-        font = py.font.Font('freesansbold.ttf', self.FONT_SIZE_LARGE)
-        text = font.render(menu_text, True, self.COLOR_TEXT_START_MENU)
-        text_rect = text.get_rect()
-        text_rect.center = (self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2 - 40)
-        self.screen_surface.blit(text, text_rect)
-
-        font = py.font.Font('freesansbold.ttf', self.FONT_SIZE_NORMAL)
-        text = font.render(btn_text, True, self.COLOR_TEXT_START_MENU)
+        self.draw_menu("GAME OVER")
+        self.game_over_menu_drawn = True
+
+    def get_menu_rect(self):
+        return py.Rect((self.SCREEN_WIDTH / 2) - (self.MENU_WIDTH / 2), (self.SCREEN_HEIGHT / 2) - (self.MENU_HEIGHT / 2),
+                       self.MENU_WIDTH, self.MENU_HEIGHT)
+
+    def draw_menu_text(self, menu_text, btn_text, surface=None):
+        self.draw_text(menu_text, self.FONT_SIZE_LARGE, self.COLOR_TEXT_START_MENU, 
+                       (self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2 - 40), surface)
+        self.draw_text(btn_text, self.FONT_SIZE_NORMAL, self.COLOR_TEXT_START_MENU, 
+                       (self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2 + 40), surface)
+
+    def draw_text(self, text, font_size, color, center, surface=None):
+        surface = self.screen_surface if surface is None else surface
+        text = self.text_cache.render(text, font_size, color)
         text_rect = text.get_rect()
-        text_rect.center = (self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2 + 40)
-        self.screen_surface.blit(text, text_rect)
+        text_rect.center = center
+        surface.blit(text, text_rect)
     
-    def draw_default_start_and_end_game_rect(self):
-        rect_width = 300
-        rect_height = 200
-        top_left = ((self.SCREEN_WIDTH / 2) - (rect_width / 2), (self.SCREEN_HEIGHT / 2) - (rect_height / 2))
+    def draw_default_start_and_end_game_rect(self, surface=None):
         corner_radius = 30
         border_thickness = 5
-        rect = py.Rect(top_left[0], top_left[1], rect_width, rect_height)
-        self.draw_bordered_rounded_rect(rect, self.COLOR_START_MENU_BG, self.COLOR_START_MENU_BORDER, corner_radius, border_thickness)
+        rect = self.get_menu_rect()
+        self.draw_bordered_rounded_rect(rect, self.COLOR_START_MENU_BG, self.COLOR_START_MENU_BORDER, corner_radius, border_thickness, surface)
 
         corner_radius = 10
         border_thickness = 4
         rect = py.Rect(self.BTN_TOP_LEFT_X, self.BTN_TOP_LEFT_Y, self.BTN_WIDTH, self.BTN_HEIGHT)
-        self.draw_bordered_rounded_rect(rect, self.COLOR_BTN_START_GAME_BG, self.COLOR_BTN_START_GAME_BORDER, corner_radius, border_thickness)
+        self.draw_bordered_rounded_rect(rect, self.COLOR_BTN_START_GAME_BG, self.COLOR_BTN_START_GAME_BORDER, corner_radius, border_thickness, surface)
 
-    def draw_rounded_rect(self, rect, color, corner_radius):
-        py.gfxdraw.aacircle(self.screen_surface, rect.left + corner_radius, rect.top + corner_radius, corner_radius, color)
-        py.gfxdraw.aacircle(self.screen_surface, rect.left + corner_radius, rect.bottom - corner_radius - 1, corner_radius, color)
-        py.gfxdraw.aacircle(self.screen_surface, rect.right - corner_radius - 1, rect.top + corner_radius, corner_radius, color)
-        py.gfxdraw.aacircle(self.screen_surface, rect.right - corner_radius - 1, rect.bottom - corner_radius - 1, corner_radius, color)
+    def draw_rounded_rect(self, rect, color, corner_radius, surface=None):
+        surface = self.screen_surface if surface is None else surface
+        py.gfxdraw.aacircle(surface, rect.left + corner_radius, rect.top + corner_radius, corner_radius, color)
+        py.gfxdraw.aacircle(surface, rect.left + corner_radius, rect.bottom - corner_radius - 1, corner_radius, color)
+        py.gfxdraw.aacircle(surface, rect.right - corner_radius - 1, rect.top + corner_radius, corner_radius, color)
+        py.gfxdraw.aacircle(surface, rect.right - corner_radius - 1, rect.bottom - corner_radius - 1, corner_radius, color)
 
-        py.gfxdraw.filled_circle(self.screen_surface, rect.left + corner_radius, rect.top + corner_radius, corner_radius, color)
-        py.gfxdraw.filled_circle(self.screen_surface, rect.left + corner_radius, rect.bottom - corner_radius - 1, corner_radius, color)
-        py.gfxdraw.filled_circle(self.screen_surface, rect.right - corner_radius - 1, rect.top + corner_radius, corner_radius, color)
-        py.gfxdraw.filled_circle(self.screen_surface, rect.right - corner_radius - 1, rect.bottom - corner_radius - 1, corner_radius, color)
+        py.gfxdraw.filled_circle(surface, rect.left + corner_radius, rect.top + corner_radius, corner_radius, color)
+        py.gfxdraw.filled_circle(surface, rect.left + corner_radius, rect.bottom - corner_radius - 1, corner_radius, color)
+        py.gfxdraw.filled_circle(surface, rect.right - corner_radius - 1, rect.top + corner_radius, corner_radius, color)
+        py.gfxdraw.filled_circle(surface, rect.right - corner_radius - 1, rect.bottom - corner_radius - 1, corner_radius, color)
 
         rect_tmp = py.Rect(rect)
 
         rect_tmp.width -= 2 * corner_radius
         rect_tmp.center = rect.center
-        pygame.draw.rect(self.screen_surface, color, rect_tmp)
+        pygame.draw.rect(surface, color, rect_tmp)
 
         rect_tmp.width = rect.width
         rect_tmp.height -= 2 * corner_radius
         rect_tmp.center = rect.center
-        pygame.draw.rect(self.screen_surface, color, rect_tmp)
+        pygame.draw.rect(surface, color, rect_tmp)
 
-    def draw_bordered_rounded_rect(self, rect, color, border_color, corner_radius, border_thickness):
+    def draw_bordered_rounded_rect(self, rect, color, border_color, corner_radius, border_thickness, surface=None):
+        surface = self.screen_surface if surface is None else surface
         if corner_radius < 0:
             raise ValueError(f"border radius ({corner_radius}) must be >= 0")
 
@@ -152,9 +295,9 @@ class TetrisUI(object):
 
         if border_thickness:
             if corner_radius <= 0:
-                pygame.draw.rect(self.screen_surface, border_color, rect_tmp)
+                pygame.draw.rect(surface, border_color, rect_tmp)
             else:
-                self.draw_rounded_rect(rect_tmp, border_color, corner_radius)
+                self.draw_rounded_rect(rect_tmp, border_color, corner_radius, surface)
 
             rect_tmp.inflate_ip(-2*border_thickness, -2*border_thickness)
             inner_radius = corner_radius - border_thickness + 1
@@ -162,93 +305,148 @@ class TetrisUI(object):
             inner_radius = corner_radius
 
         if inner_radius <= 0:
-            pygame.draw.rect(self.screen_surface, color, rect_tmp)
+            pygame.draw.rect(surface, color, rect_tmp)
         else:
-            self.draw_rounded_rect(rect_tmp, color, inner_radius)
+            self.draw_rounded_rect(rect_tmp, color, inner_radius, surface)
 
     def draw_background(self):
-        self.screen_surface.fill(self.COLOR_BACKGROUND)
+        self.build_layers()
+        self.screen_surface.blit(self.background_layer, (0, 0))
+        self.drawn_squares = None
+        self.drawn_game_data = None
+        self.game_over_menu_drawn = False
+        self.profiler_overlay_drawn = None
+        self.full_redraw = True
     
-    def draw_playing_grid(self):
+    def draw_playing_grid(self, surface=None):
+        surface = self.screen_surface if surface is None else surface
         for col in range(0, self.NUM_OF_SQUARES_COLUMS + 1):
-            py.draw.line(self.screen_surface, 
+            py.draw.line(surface, 
                         self.COLOR_GRID_LINES, 
                         (self.POS_SQUARES_TOP_LEFT[1] + (col * self.SIZE_OF_SQUARE), self.POS_SQUARES_TOP_LEFT[0]),
                         (self.POS_SQUARES_TOP_LEFT[1] + (col * self.SIZE_OF_SQUARE), self.POS_SQUARES_BUTTOM_RIGHT[0]),
                         self.LINE_WIDTH_2)
         for row in range(0, self.NUM_OF_SQUARES_ROWS + 1):
-            py.draw.line(self.screen_surface, 
+            py.draw.line(surface, 
                         self.COLOR_GRID_LINES, 
                         (self.POS_SQUARES_TOP_LEFT[1], self.POS_SQUARES_TOP_LEFT[0] + (row * self.SIZE_OF_SQUARE)),
                         (self.POS_SQUARES_BUTTOM_RIGHT[1], self.POS_SQUARES_TOP_LEFT[0] + (row * self.SIZE_OF_SQUARE)),
                         self.LINE_WIDTH_2)
 
-    def draw_border_on_playing_area(self):
-        py.draw.rect(self.screen_surface, 
+    def draw_border_on_playing_area(self, surface=None):
+        surface = self.screen_surface if surface is None else surface
+        py.draw.rect(surface, 
                      self.COLOR_GRID_LINES,
                      (self.POS_SQUARES_TOP_LEFT[1], self.POS_SQUARES_TOP_LEFT[0],
                      self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_COLUMS, 
                      self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_ROWS),
                      self.LINE_WIDTH_5)
 
+    def get_square_rect(self, row, col):
+        return py.Rect(self.POS_SQUARES_TOP_LEFT[1] + self.SIZE_OF_SQUARE * col, 
+                       self.POS_SQUARES_TOP_LEFT[0] + self.SIZE_OF_SQUARE * row, 
+                       self.SIZE_OF_SQUARE, self.SIZE_OF_SQUARE)
+
+    def get_playing_field_squares(self):
+        # Shape id of every square as it should be drawn, row by row, with
+        # SQUARE_GHOST where the ghost piece is shown.
+        squares = list(self.game_logic.board.shape_ids)
+        piece_cells = self.game_logic.current_piece.cells()
+        num_of_squares_to_drop_piece = self.game_logic.get_drop_distance()
+        for row, col in piece_cells:
+            squares[(row + num_of_squares_to_drop_piece) * self.NUM_OF_SQUARES_COLUMS + col] = self.SQUARE_GHOST
+        for row, col in piece_cells:
+            squares[row * self.NUM_OF_SQUARES_COLUMS + col] = self.game_logic.current_shape_id
+        return squares
+
+    def get_square_sprite(self, square):
+        if square == self.SQUARE_GHOST:
+            return self.tile_sprites[tpiece.SHAPE_ID_EMPTY]
+        return self.tile_sprites[square]
+
     def draw_playing_field(self):
-        for row in range(self.NUM_OF_SQUARES_ROWS):
-            for col in range(self.NUM_OF_SQUARES_COLUMS):
-                py.draw.rect(self.screen_surface, 
-                    self.COLOR_PIECE_ALL[self.game_logic.grid[row][col].shape_id],
-                    (self.POS_SQUARES_TOP_LEFT[1] + self.SIZE_OF_SQUARE * col, 
-                    self.POS_SQUARES_TOP_LEFT[0] + self.SIZE_OF_SQUARE * row, 
-                    self.SIZE_OF_SQUARE, self.SIZE_OF_SQUARE))
-        self.draw_playing_grid()
-        self.draw_ghost_location_if_piece_is_droped()
-        self.draw_border_on_playing_area()
+        self.build_layers()
+        squares = self.get_playing_field_squares()
+        if self.drawn_squares is None:
+            rects = [self.get_square_rect(i // self.NUM_OF_SQUARES_COLUMS, i % self.NUM_OF_SQUARES_COLUMS)
+                     for i in range(len(squares))]
+            self.screen_surface.blits([(self.get_square_sprite(square), rect) for square, rect in zip(squares, rects)], 
+                                      False)
+            field_rect = self.get_playing_field_rect()
+            self.screen_surface.blit(self.grid_layer, field_rect, field_rect)
+            self.screen_surface.blits([(self.ghost_sprite, rect) for square, rect in zip(squares, rects) 
+                                       if square == self.SQUARE_GHOST], False)
+            self.screen_surface.blit(self.border_layer, field_rect, field_rect)
+            self.dirty_rects.append(field_rect)
+        else:
+            for i in range(len(squares)):
+                if not squares[i] == self.drawn_squares[i]:
+                    self.draw_square(i // self.NUM_OF_SQUARES_COLUMS, i % self.NUM_OF_SQUARES_COLUMS, squares[i])
+        self.drawn_squares = squares
+
+    def draw_square(self, row, col, square):
+        # Repaints one square with every layer that overlaps it, so the
+        # neighbours are left untouched.
+        rect = self.get_square_rect(row, col)
+        self.screen_surface.blit(self.get_square_sprite(square), rect)
+        self.screen_surface.blit(self.grid_layer, rect, rect)
+        if square == self.SQUARE_GHOST:
+            self.screen_surface.blit(self.ghost_sprite, rect)
+        self.screen_surface.blit(self.border_layer, rect, rect)
+        self.dirty_rects.append(rect)
+
+    def get_squares_rect(self):
+        return py.Rect(self.POS_SQUARES_TOP_LEFT[1], self.POS_SQUARES_TOP_LEFT[0],
+                       self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_COLUMS, 
+                       self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_ROWS)
+
+    def get_playing_field_rect(self):
+        border = self.LINE_WIDTH_5
+        return py.Rect(self.POS_SQUARES_TOP_LEFT[1] - border, self.POS_SQUARES_TOP_LEFT[0] - border,
+                       self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_COLUMS + 2 * border,
+                       self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_ROWS + 2 * border)
 
     def draw_game_data(self):
-        box_width = 220
-        box_height = 200
-        top_off_set = 100
+        game_data = (self.game_logic.num_of_rows_cleared, self.game_logic.max_height_of_stacked_pieces, 
+                     self.game_logic.num_of_holes, self.game_logic.next_shape_id)
+        if game_data == self.drawn_game_data:
+            return
+        self.drawn_game_data = game_data
+
+        box_width = self.DATA_BOX_WIDTH
+        box_height = self.DATA_BOX_HEIGHT
+        top_off_set = self.DATA_BOX_TOP_OFF_SET
 
         center_left_column = (self.SCREEN_WIDTH / 2 - (self.SIZE_OF_SQUARE * self.NUM_OF_SQUARES_COLUMS) / 2) / 2
         center_right_column = self.SCREEN_WIDTH - center_left_column
+        # Clear both boxes with their titles, so the text is not drawn on
+        # top of itself.
+        for center in (center_left_column, center_right_column):
+            rect = py.Rect(center - (box_width / 2), top_off_set - self.DATA_TITLE_HEIGHT, 
+                           box_width, box_height + self.DATA_TITLE_HEIGHT)
+            self.screen_surface.fill(self.COLOR_BACKGROUND, rect)
+            self.dirty_rects.append(rect)
+
         py.draw.rect(self.screen_surface, 
                     self.COLOR_GRID_BG, 
                     (center_left_column - (box_width / 2), top_off_set, box_width, box_height) )
 
         self.draw_next_piece(center_right_column, top_off_set, box_width, box_height)
 
-        font = py.font.Font('freesansbold.ttf', self.FONT_SIZE_LARGE)
-        text = font.render("Game stats", True, self.COLOR_TEXT)
-        text_rect = text.get_rect()
-        text_rect.center = (center_left_column , top_off_set - 30)
-        self.screen_surface.blit(text, text_rect)
-
-        font = py.font.Font('freesansbold.ttf', self.FONT_SIZE_NORMAL)
-        text = font.render("Rows Cleared: " + str(self.game_logic.num_of_rows_cleared), True, self.COLOR_TEXT)
-        text_rect = text.get_rect()
-        text_rect.center = (center_left_column , 150)
-        self.screen_surface.blit(text, text_rect)
-
-        text = font.render("Height: " + str(self.game_logic.max_height_of_stacked_pieces), True, self.COLOR_TEXT)
-        text_rect = text.get_rect()
-        text_rect.center = (center_left_column , 200)
-        self.screen_surface.blit(text, text_rect)
-
-        text = font.render("Holes: " + str(self.game_logic.num_of_holes), True, self.COLOR_TEXT)
-        text_rect = text.get_rect()
-        text_rect.center = (center_left_column , 250)
-        self.screen_surface.blit(text, text_rect)
+        self.draw_text("Game stats", self.FONT_SIZE_LARGE, self.COLOR_TEXT, (center_left_column , top_off_set - 30))
+        self.draw_text("Rows Cleared: " + str(self.game_logic.num_of_rows_cleared), self.FONT_SIZE_NORMAL, 
+                       self.COLOR_TEXT, (center_left_column , 150))
+        self.draw_text("Height: " + str(self.game_logic.max_height_of_stacked_pieces), self.FONT_SIZE_NORMAL, 
+                       self.COLOR_TEXT, (center_left_column , 200))
+        self.draw_text("Holes: " + str(self.game_logic.num_of_holes), self.FONT_SIZE_NORMAL, 
+                       self.COLOR_TEXT, (center_left_column , 250))
 
     def draw_next_piece(self, center_right_column, top_off_set, box_width, box_height):
         py.draw.rect(self.screen_surface, 
                     self.COLOR_GRID_BG, 
                     (center_right_column - (box_width / 2), top_off_set, box_width, box_height))
 
-        font = py.font.Font('freesansbold.ttf', self.FONT_SIZE_LARGE)
-
-        text = font.render("Next piece", True, self.COLOR_TEXT)
-        text_rect = text.get_rect()
-        text_rect.center = (center_right_column , top_off_set - 30)
-        self.screen_surface.blit(text, text_rect)
+        self.draw_text("Next piece", self.FONT_SIZE_LARGE, self.COLOR_TEXT, (center_right_column , top_off_set - 30))
 
         
         mini_grid = [[tpiece.SHAPE_ID_EMPTY, tpiece.SHAPE_ID_EMPTY, tpiece.SHAPE_ID_EMPTY, tpiece.SHAPE_ID_EMPTY],
@@ -261,110 +459,151 @@ class TetrisUI(object):
         for coordinate in tpiece.SPAWN_LOCATION_ALL[self.game_logic.next_shape_id]:
             mini_grid[coordinate[0]][coordinate[1] - 3] = self.game_logic.next_shape_id
         
-        for row in range(len(mini_grid)):
-            for col in range(len(mini_grid)):
-                if not mini_grid[row][col] == -1:
-                    py.draw.rect(self.screen_surface, 
-                                self.COLOR_PIECE_ALL[mini_grid[row][col]], 
-                                (top_left[0] + col * self.SIZE_OF_SQUARE, 
-                                top_left[1] + row * self.SIZE_OF_SQUARE, 
-                                self.SIZE_OF_SQUARE, 
-                                self.SIZE_OF_SQUARE))
-
-    def get_num_of_squares_piece_can_drop_from_current_location(self):
-        num_of_squares_to_drop_piece = 0
-        buttom_reached = False
-        i = 1
-        while not buttom_reached and i < self.NUM_OF_SQUARES_ROWS:
-            for row in range(self.NUM_OF_SQUARES_ROWS):
-                for col in range(self.NUM_OF_SQUARES_COLUMS):
-                    if self.game_logic.grid[row][col].piece_id == self.game_logic.current_piece_id:
-                        if i + row >= self.NUM_OF_SQUARES_ROWS:
-                            num_of_squares_to_drop_piece = i - 1
-                            buttom_reached = True
-                            break
-                        if not self.game_logic.grid[row + i][col].empty and not \
-                            self.game_logic.grid[row + i][col].piece_id == self.game_logic.current_piece_id:
-                            num_of_squares_to_drop_piece = i - 1
-                            buttom_reached = True
-                            break
-            i += 1
-        if i == self.NUM_OF_SQUARES_ROWS:
-            num_of_squares_to_drop_piece = self.NUM_OF_SQUARES_ROWS - 2
-        return num_of_squares_to_drop_piece
-
-    def draw_ghost_location_if_piece_is_droped(self):
-        num_of_squares_to_drop_piece = self.get_num_of_squares_piece_can_drop_from_current_location()
-        border_thickness = 4
-        for row in range(self.NUM_OF_SQUARES_ROWS):
-            for col in range(self.NUM_OF_SQUARES_COLUMS):
-                if self.game_logic.grid[row][col].piece_id == self.game_logic.current_piece_id:
-                    if not self.game_logic.grid[row + num_of_squares_to_drop_piece][col].piece_id == self.game_logic.current_piece_id:
-                        py.draw.rect(self.screen_surface, 
-                                     self.COLOR_GHOST_PIECE_LINE, 
-                                    (self.POS_SQUARES_TOP_LEFT[1] + col * self.SIZE_OF_SQUARE, 
-                                     self.POS_SQUARES_TOP_LEFT[0] + (row + num_of_squares_to_drop_piece) * self.SIZE_OF_SQUARE, 
-                                     self.SIZE_OF_SQUARE, 
-                                     self.SIZE_OF_SQUARE),
-                                     border_thickness )
+        self.screen_surface.blits([(self.tile_sprites[mini_grid[row][col]], 
+                                    (top_left[0] + col * self.SIZE_OF_SQUARE, top_left[1] + row * self.SIZE_OF_SQUARE))
+                                   for row in range(len(mini_grid)) for col in range(len(mini_grid))
+                                   if not mini_grid[row][col] == -1], False)
 
     def update_display(self):
-        py.display.update()
-        self.clock.tick(self.fps)
+        if self.full_redraw:
+            py.display.update()
+        elif self.dirty_rects:
+            py.display.update(self.dirty_rects)
+        self.dirty_rects = []
+        self.full_redraw = False
+
+    def is_on_start_button(self, pos):
+        x, y = pos[0], pos[1]
+        return self.BTN_TOP_LEFT_X < x < self.BTN_TOP_LEFT_X + self.BTN_WIDTH and \
+            self.BTN_TOP_LEFT_Y < y < self.BTN_TOP_LEFT_Y + self.BTN_HEIGHT
+
+    def draw_profiler_overlay(self):
+        # Rolling p50/p95/p99 of every profiled phase, refreshed at most
+        # every PROFILER_OVERLAY_UPDATE_SEC.
+        if not self.show_profiler_overlay:
+            return
+        now = perf_counter()
+        if self.profiler_overlay_drawn is not None and \
+            now - self.profiler_overlay_drawn < self.PROFILER_OVERLAY_UPDATE_SEC:
+            return
+        self.profiler_overlay_drawn = now
+
+        rect = py.Rect(self.PROFILER_OVERLAY_RECT)
+        self.screen_surface.fill(self.COLOR_GRID_BG, rect)
+        font = self.text_cache.get_font(self.FONT_SIZE_OVERLAY)
+        lines = [("phase (ms)", "p50", "p95", "p99")]
+        for phase in self.profiler.samples:
+            lines.append([phase] + [f"{seconds * 1000:.2f}" for seconds in self.profiler.get_percentiles(phase)])
+        max_lines = (rect.height - 10) // self.PROFILER_OVERLAY_LINE_HEIGHT
+        for i, line in enumerate(lines[:max_lines]):
+            for text, x in zip(line, self.PROFILER_OVERLAY_COLUMNS):
+                self.screen_surface.blit(font.render(text, True, self.COLOR_TEXT), 
+                                         (rect.left + x, rect.top + 5 + i * self.PROFILER_OVERLAY_LINE_HEIGHT))
+        self.dirty_rects.append(rect)
+
+    def toggle_profiler_overlay(self):
+        self.show_profiler_overlay = not self.show_profiler_overlay
+        self.profiler_overlay_drawn = None
+        if not self.show_profiler_overlay:
+            rect = py.Rect(self.PROFILER_OVERLAY_RECT)
+            self.screen_surface.blit(self.background_layer, rect, rect)
+            self.dirty_rects.append(rect)
+        self.state_changed = True
+
+    def quit(self):
+        if self.profiler and self.profiler_output:
+            self.profiler.dump(self.profiler_output)
+        py.quit()
+        quit()
+
+    def handle_event(self, event):
+        if event.type == py.QUIT:
+            self.quit()
+        if event.type == py.KEYDOWN and event.key == py.K_ESCAPE:
+            self.quit()
+        if event.type == py.KEYDOWN and event.key == self.KEY_PROFILER_OVERLAY and self.profiler:
+            self.toggle_profiler_overlay()
+        if event.type == py.WINDOWEXPOSED:
+            self.full_redraw = True
+            self.state_changed = True
+
+        if self.game_logic.running_game:
+            if event.type == py.KEYDOWN and event.key in self.KEY_ACTIONS:
+                # Applied right away, without waiting for the next logic tick.
+                self.game_logic.step(self.KEY_ACTIONS[event.key], 0)
+                self.state_changed = True
+        elif event.type == py.MOUSEBUTTONDOWN and self.is_on_start_button(event.pos):
+            self.init_game()
+            self.new_game = False
+            self.game_logic.running_game = True
+            self.next_logic_tick = perf_counter()
+            self.state_changed = True
+
+    def update_logic(self, now):
+        # Runs every logic tick that is due, one fixed timestep at a time.
+        tick_length = 1 / self.LOGIC_TICKS_PER_SEC
+        if now - self.next_logic_tick > self.MAX_LOGIC_LAG_SEC:
+            self.next_logic_tick = now
+        while self.game_logic.running_game and self.next_logic_tick <= now:
+            # Most ticks only move the fall timer, those need no new frame.
+            fall_state = (self.game_logic.num_of_pieces_placed, self.game_logic.current_piece.origin_row)
+            self.game_logic.step(tgame.ACTION_NONE, 1)
+            self.next_logic_tick += tick_length
+            if not fall_state == (self.game_logic.num_of_pieces_placed, self.game_logic.current_piece.origin_row):
+                self.state_changed = True
+
+    def render(self):
+        if self.new_game:
+            self.draw_screen_layout()
+            self.draw_start_menu()
+        else:
+            self.draw_playing_field()
+            self.draw_game_data()
+            if not self.game_logic.running_game and not self.game_over_menu_drawn:
+                self.draw_game_over_menu()
+        self.draw_profiler_overlay()
+        self.update_display()
+        self.state_changed = False
+
+    def get_wait_time(self, now):
+        # Seconds until the loop has something to do, None to sleep until
+        # the next event.
+        wake_ups = []
+        if self.game_logic.running_game:
+            wake_ups.append(self.next_logic_tick)
+        if self.state_changed:
+            wake_ups.append(self.last_render + 1 / self.fps)
+        if not wake_ups:
+            return None
+        return max(0, min(wake_ups) - now)
 
     def run(self):
         while True:
-            for event in py.event.get():
-                if self.new_game and not self.game_logic.running_game:
-                    self.draw_screen_layout()
-                    self.draw_start_menu()
-                    if event.type == py.MOUSEBUTTONDOWN:
-                        x, y = event.pos[0], event.pos[1]
-                        if self.BTN_TOP_LEFT_X < x < self.BTN_TOP_LEFT_X + self.BTN_WIDTH and \
-                            self.BTN_TOP_LEFT_Y < y < self.BTN_TOP_LEFT_Y + self.BTN_HEIGHT:
-                            self.init_game()
-                            self.new_game = False
-                            self.game_logic.running_game = True
-                elif not self.new_game and self.game_logic.running_game:
-                    if event.type == py.KEYDOWN:
-                        if event.key == py.K_SPACE:
-                            self.game_logic.drop_current_piece_to_bottom()
-                        if event.key == py.K_DOWN:
-                            if self.game_logic.can_current_piece_move_one_down():
-                                self.game_logic.move_current_piece_one_down()
-                        if event.key == py.K_LEFT:
-                            self.game_logic.move_current_piece_one_left()
-                        if event.key == py.K_RIGHT:
-                            self.game_logic.move_current_piece_one_right()
-                        if event.key == py.K_UP:
-                            self.game_logic.rotate_piece_clock_wise()
-                elif not self.new_game and not self.game_logic.running_game:
-                    if event.type == py.MOUSEBUTTONDOWN:
-                        x, y = event.pos[0], event.pos[1]
-                        if self.BTN_TOP_LEFT_X < x < self.BTN_TOP_LEFT_X + self.BTN_WIDTH and \
-                            self.BTN_TOP_LEFT_Y < y < self.BTN_TOP_LEFT_Y + self.BTN_HEIGHT:
-                            self.init_game()
-                            self.new_game = False
-                            self.game_logic.running_game = True
-
-                if event.type == py.QUIT:
-                    py.quit()
-                    quit()
-                if event.type == py.KEYDOWN:
-                    if event.key == py.K_ESCAPE:
-                        py.quit()
-                        quit()
-            
-            if not self.new_game:
-                self.game_logic.update_timers()
-                self.draw_playing_field()
-                self.draw_game_data()
-                if not self.game_logic.running_game:
-                    self.draw_game_over_menu()
-
-            self.update_display()
+            # Sleeps until the next event or the next scheduled logic tick or
+            # frame, and then drains every queued event at once.
+            wait_time = self.get_wait_time(perf_counter())
+            if wait_time is None:
+                events = [py.event.wait()]
+            elif wait_time > 0:
+                events = [py.event.wait(math.ceil(wait_time * 1000))]
+            else:
+                events = []
+            for event in events + py.event.get():
+                if not event.type == py.NOEVENT:
+                    self.handle_event(event)
+
+            now = perf_counter()
+            if self.game_logic.running_game:
+                self.update_logic(now)
+            if self.state_changed and now - self.last_render >= 1 / self.fps:
+                self.last_render = now
+                self.render()
 
 
 if __name__ == '__main__':
-    tetris = TetrisUI()
+    parser = argparse.ArgumentParser(description='Play Tetris.')
+    parser.add_argument('--profile', metavar='FILE', 
+                        help='time the game and UI phases, F3 shows them, written to FILE (.csv or .json) on exit')
+    args = parser.parse_args()
+    tetris = TetrisUI(Profiler() if args.profile else None, args.profile)
     tetris.run()
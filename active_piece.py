@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+from pieces import TetrisPiece as tpiece
+from rotation_table import RotationTable as rtable
+
+@dataclass
+class ActivePiece:
+    shape_id: int = tpiece.SHAPE_ID_EMPTY
+    rotation: int = 0
+    origin_row: int = 0
+    origin_col: int = 0
+    # ((row, col), ...) of every square relative to the origin.
+    offsets: tuple = ()
+
+    @classmethod
+    def spawn(cls, shape_id):
+        origin_row, origin_col = rtable.SPAWN_ORIGIN_ALL[shape_id]
+        return cls(shape_id, 0, origin_row, origin_col, rtable.STATES_ALL[shape_id][0])
+
+    def cells(self):
+        return [(self.origin_row + d_row, self.origin_col + d_col) for d_row, d_col in self.offsets]
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from time import perf_counter
+
+from game import TetrisGame as tgame
+from pieces import TetrisPiece as tpiece
+from rotation_table import RotationTable as rtable
+from transposition_cache import TranspositionCache
+
+# Heuristic weights. Heights and holes use the same definitions as the
+# TetrisGame column stats: a hole is an empty square below the top square of
+# its column.
+WEIGHTS = {'rows_cleared':      0.76,
+           'holes':             -0.36,
+           'max_height':        -0.05,
+           'aggregate_height':  -0.51,
+           'bumpiness':         -0.18,
+           'wells':             -0.10,
+           'row_transitions':   -0.10}
+
+def get_drop_states(shape_id):
+    # Distinct rotation footprints of a shape as ((d_row, d_col), ...),
+    # identical ones, like the four of the O, only once.
+    states = []
+    footprints = set()
+    for offsets in rtable.STATES_ALL[shape_id]:
+        min_d_row = min(d_row for d_row, d_col in offsets)
+        min_d_col = min(d_col for d_row, d_col in offsets)
+        footprint = frozenset((d_row - min_d_row, d_col - min_d_col) for d_row, d_col in offsets)
+        if footprint not in footprints:
+            footprints.add(footprint)
+            states.append(offsets)
+    return states
+
+DROP_STATES_ALL = [get_drop_states(shape_id) for shape_id in range(tgame.NUM_OF_SHAPES)]
+
+def lock_and_clear(masks, cells, num_of_columns):
+    # Row masks after locking cells and removing the full rows, and the
+    # number of removed rows. Mirrors TetrisGame, which never clears the top
+    # row.
+    masks = masks[:]
+    for row, col in cells:
+        masks[row] |= 1 << col
+    full_row_mask = (1 << num_of_columns) - 1
+    kept = [row_mask for row, row_mask in enumerate(masks) if row == 0 or not row_mask == full_row_mask]
+    num_of_cleared = len(masks) - len(kept)
+    if num_of_cleared:
+        masks = [0] * num_of_cleared + kept
+    return masks, num_of_cleared
+
+def get_column_tops(masks, num_of_columns):
+    # Row of the top square of every column, num_of_rows if empty.
+    tops = [len(masks)] * num_of_columns
+    covered = 0
+    for row, row_mask in enumerate(masks):
+        new = row_mask & ~covered
+        while new:
+            low = new & -new
+            tops[low.bit_length() - 1] = row
+            new ^= low
+        covered |= row_mask
+    return tops
+
+def get_features(masks, num_of_columns):
+    num_of_rows = len(masks)
+    wall_mask = 1 | (1 << (num_of_columns + 1))
+    heights = [0] * num_of_columns
+    holes = 0
+    row_transitions = 0
+    covered = 0
+    for row, row_mask in enumerate(masks):
+        if not covered and not row_mask:
+            continue
+        new = row_mask & ~covered
+        while new:
+            low = new & -new
+            heights[low.bit_length() - 1] = num_of_rows - row
+            new ^= low
+        holes += (covered & ~row_mask).bit_count()
+        covered |= row_mask
+        # Filled/empty changes along the row, the walls count as filled.
+        walled = (row_mask << 1) | wall_mask
+        row_transitions += (walled ^ (walled >> 1)).bit_count() - 1
+
+    bumpiness = 0
+    wells = 0
+    for col in range(num_of_columns):
+        left = heights[col - 1] if col > 0 else num_of_rows
+        right = heights[col + 1] if col < num_of_columns - 1 else num_of_rows
+        if col < num_of_columns - 1:
+            bumpiness += abs(heights[col] - right)
+        depth = min(left, right) - heights[col]
+        if depth > 0:
+            wells += depth
+    return {'holes': holes,
+            'max_height': max(heights),
+            'aggregate_height': sum(heights),
+            'bumpiness': bumpiness,
+            'wells': wells,
+            'row_transitions': row_transitions}
+
+def evaluate(masks, num_of_columns, rows_cleared, weights):
+    score = weights['rows_cleared'] * rows_cleared
+    for name, value in get_features(masks, num_of_columns).items():
+        score += weights[name] * value
+    return score
+
+def get_drop_placements(masks, num_of_columns, shape_id):
+    # Cells of every placement reachable by rotating and moving at the top
+    # and dropping straight down. Placements sticking out at the top are
+    # left out, they end the game.
+    tops = get_column_tops(masks, num_of_columns)
+    placements = []
+    for offsets in DROP_STATES_ALL[shape_id]:
+        min_d_col = min(d_col for d_row, d_col in offsets)
+        max_d_col = max(d_col for d_row, d_col in offsets)
+        min_d_row = min(d_row for d_row, d_col in offsets)
+        for origin_col in range(-min_d_col, num_of_columns - max_d_col):
+            origin_row = min(tops[origin_col + d_col] - 1 - d_row for d_row, d_col in offsets)
+            if origin_row + min_d_row >= 0:
+                placements.append([(origin_row + d_row, origin_col + d_col) for d_row, d_col in offsets])
+    return placements
+
+# Best scores of boards for a shape, per process.
+best_drop_cache = TranspositionCache()
+
+def get_best_drop_value(masks, num_of_columns, shape_id, weights):
+    # Best heuristic value of dropping shape_id on the board, counting only
+    # the rows this drop clears. None if the shape cannot be placed.
+    def compute():
+        best = None
+        for cells in get_drop_placements(masks, num_of_columns, shape_id):
+            child, num_of_cleared = lock_and_clear(masks, cells, num_of_columns)
+            value = evaluate(child, num_of_columns, num_of_cleared, weights)
+            if best is None or value > best:
+                best = value
+        return best
+    return best_drop_cache.get_or_compute((tuple(masks), shape_id, tuple(weights.items())), compute)
+
+def get_expected_value(masks, num_of_columns, rows_cleared, next_shape_id, lookahead, weights, game_over_value):
+    # Value of a board after the current piece. With lookahead 1 the known
+    # next piece is dropped at its best place. With lookahead 2 the piece
+    # after it, which is unknown, is averaged over all shapes for the best
+    # few next placements.
+    base = weights['rows_cleared'] * rows_cleared
+    if lookahead < 1 or next_shape_id == tpiece.SHAPE_ID_EMPTY:
+        return evaluate(masks, num_of_columns, rows_cleared, weights)
+    if lookahead < 2:
+        best = get_best_drop_value(masks, num_of_columns, next_shape_id, weights)
+        return game_over_value if best is None else base + best
+
+    children = []
+    for cells in get_drop_placements(masks, num_of_columns, next_shape_id):
+        child, num_of_cleared = lock_and_clear(masks, cells, num_of_columns)
+        children.append((evaluate(child, num_of_columns, num_of_cleared, weights), child, num_of_cleared))
+    if not children:
+        return game_over_value
+    children.sort(key=lambda child: child[0], reverse=True)
+    best = None
+    for value, child, num_of_cleared in children[:AIPlayer.EXPECTIMAX_WIDTH]:
+        expected = 0.0
+        for shape_id in range(tgame.NUM_OF_SHAPES):
+            shape_value = get_best_drop_value(child, num_of_columns, shape_id, weights)
+            expected += game_over_value if shape_value is None else shape_value
+        expected = base + weights['rows_cleared'] * num_of_cleared + expected / tgame.NUM_OF_SHAPES
+        if best is None or expected > best:
+            best = expected
+    return best
+
+def evaluate_candidates(candidates, num_of_columns, next_shape_id, lookahead, weights, game_over_value):
+    # Worker pool job: [(masks, rows_cleared), ...] -> values.
+    return [get_expected_value(masks, num_of_columns, rows_cleared, next_shape_id, lookahead, weights,
+                               game_over_value)
+            for masks, rows_cleared in candidates]
+
+class AIPlayer(object):
+    '''
+        Plays TetrisGame by scoring the placements of the current piece with a
+        weighted heuristic of the board they leave. The best BEAM_WIDTH are
+        searched deeper: the next piece is dropped at its best place, and with
+        lookahead 2 the unknown piece after it is averaged over all shapes
+        (expectimax). Deeper evaluation stops at the time budget, candidates
+        that were not evaluated deeper are not chosen. Without a time budget
+        the whole beam is searched and the choices repeat for a seed.
+
+        With workers > 0 the deeper evaluation is spread over a process pool.
+    '''
+    BEAM_WIDTH          = 6
+    EXPECTIMAX_WIDTH    = 3
+    LOOKAHEAD           = 1
+    TIME_BUDGET_SEC     = 0.05
+    GAME_OVER_VALUE     = -1e6
+
+    def __init__(self, weights=None, beam_width=BEAM_WIDTH, lookahead=LOOKAHEAD, time_budget=TIME_BUDGET_SEC,
+                 workers=0):
+        self.weights = dict(WEIGHTS if weights is None else weights)
+        self.beam_width = beam_width
+        self.lookahead = lookahead
+        self.time_budget = time_budget
+        self.workers = workers
+        self.executor = None
+
+        # Inputs left of the current plan, see get_action().
+        self.planned_actions = []
+        self.planned_piece_id = None
+        self.planned_row = None
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def choose_placement(self, game):
+        # Best Placement for the current piece, None if there is none.
+        deadline = None if self.time_budget is None else perf_counter() + self.time_budget
+        num_of_columns = game.num_of_columns
+        masks = game.board.masks
+        candidates = []
+        for placement in game.enumerate_placements():
+            child, num_of_cleared = lock_and_clear(masks, placement.cells, num_of_columns)
+            candidates.append((evaluate(child, num_of_columns, num_of_cleared, self.weights),
+                               placement, child, num_of_cleared))
+        if not candidates:
+            return None
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        if self.lookahead < 1:
+            return candidates[0][1]
+
+        beam = candidates[:self.beam_width]
+        args = (num_of_columns, game.next_shape_id, self.lookahead, self.weights, self.GAME_OVER_VALUE)
+        if self.workers:
+            values = self.evaluate_on_pool(beam, args, deadline)
+        else:
+            values = []
+            for score, placement, child, num_of_cleared in beam:
+                # The first candidate is always evaluated.
+                if values and deadline is not None and perf_counter() > deadline:
+                    break
+                values.append(evaluate_candidates([(child, num_of_cleared)], *args)[0])
+        best = None
+        for value, candidate in zip(values, beam):
+            if value is not None and (best is None or value > best[0]):
+                best = (value, candidate[1])
+        return best[1] if best else beam[0][1]
+
+    def evaluate_on_pool(self, beam, args, deadline):
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        futures = [self.executor.submit(evaluate_candidates, [(child, num_of_cleared)], *args)
+                   for score, placement, child, num_of_cleared in beam]
+        wait(futures, timeout=None if deadline is None else max(0, deadline - perf_counter()))
+        values = []
+        for future in futures:
+            if future.done():
+                values.append(future.result()[0])
+            else:
+                future.cancel()
+                values.append(None)
+        return values
+
+    def play_placement(self, game):
+        # Locks the current piece at the chosen placement right away.
+        # Returns the cleared rows, or None if there was no placement.
+        placement = self.choose_placement(game)
+        if placement is None:
+            return None
+        return game.apply_placement(placement)
+
+    def get_action(self, game):
+        # One TetrisGame.ACTION_* at a time, for step(). Plans again for a new
+        # piece or when gravity moved the piece off the plan.
+        piece = game.current_piece
+        if not game.current_piece_id == self.planned_piece_id or not piece.origin_row == self.planned_row:
+            placement = self.choose_placement(game)
+            self.planned_actions = list(reversed(placement.path)) if placement else []
+            self.planned_piece_id = game.current_piece_id
+            self.planned_row = piece.origin_row
+        if not self.planned_actions:
+            return tgame.ACTION_HARD_DROP
+        action = self.planned_actions.pop()
+        if action == tgame.ACTION_DOWN:
+            self.planned_row += 1
+        return action
+
+def ai_policy(seed):
+    # selfplay policy factory. Without a time budget the choices only depend
+    # on the game, the seed is not needed and seeded games repeat.
+    return AIPlayer(time_budget=None).get_action
+
+
+if __name__ == '__main__':
+    from sim_clock import SimulationClock
+    game = tgame(clock=SimulationClock(), seed=0, verbose=False)
+    game.setup_new_game()
+    player = AIPlayer()
+    start = perf_counter()
+    while game.running_game and game.num_of_pieces_placed < 500:
+        player.play_placement(game)
+    wall_time = perf_counter() - start
+    print(f'{game.num_of_pieces_placed} pieces, {game.num_of_rows_cleared} rows cleared, '
+          f'{game.num_of_pieces_placed / wall_time:.0f} decisions/s')
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from game import TetrisGame as tgame
+from pieces import TetrisPiece as tpiece
+from rotation_table import RotationTable as rtable
+
+def pad_kick_offsets(kick_offsets_all):
+    # Pads every shape to the same number of kicks by repeating the in place
+    # kick, which never changes the outcome of a rotation.
+    num_of_kicks = max(len(kicks) for kicks in kick_offsets_all)
+    return [kicks + ((0, 0),) * (num_of_kicks - len(kicks)) for kicks in kick_offsets_all]
+
+class BatchTetrisGame(object):
+    '''
+        Runs N games in lockstep on NumPy arrays. The boards are stored as an
+        (N, rows, cols) uint8 array of shape ids and the falling pieces as one
+        array entry per game.
+
+        One step() applies one action per game and then one gravity drop, which
+        follows the same rules as TetrisGame.apply_action() followed by
+        TetrisGame.apply_gravity(), see check_against_scalar().
+
+        Pieces come from a seeded NumPy generator, or with piece_generators
+        from one PieceGenerator per game, like TetrisGame.
+    '''
+    # (shape, rotation, square, [row, col]) offsets relative to the origin.
+    STATES_ALL          = np.array([[state if state else ((0, 0),) * 4 for state in states]
+                                    for states in rtable.STATES_ALL], dtype=np.int32)
+    # (shape, kick, [row, col])
+    KICK_OFFSETS_ALL    = np.array(pad_kick_offsets(rtable.KICK_OFFSETS_ALL), dtype=np.int32)
+    MAX_NUM_OF_KICKS    = KICK_OFFSETS_ALL.shape[1]
+    SPAWN_ORIGIN_ALL    = np.array(rtable.SPAWN_ORIGIN_ALL, dtype=np.int32)
+
+    ROTATION_ACTIONS    = ((tgame.ACTION_ROTATE_CW, 1), (tgame.ACTION_ROTATE_CCW, 3), (tgame.ACTION_ROTATE_180, 2))
+    MOVE_ACTIONS        = ((tgame.ACTION_LEFT, 0, -1), (tgame.ACTION_RIGHT, 0, 1), (tgame.ACTION_DOWN, 1, 0))
+
+    def __init__(self, num_of_games, num_of_rows=20, num_of_columns=10, seed=None, piece_generators=None):
+        if piece_generators is not None and not len(piece_generators) == num_of_games:
+            raise ValueError(f"piece_generators ({len(piece_generators)}) must have one per game ({num_of_games})")
+        self.num_of_games = num_of_games
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.rng = np.random.default_rng(seed)
+        self.piece_generators = piece_generators
+
+        self.board = np.full((num_of_games, num_of_rows, num_of_columns), tpiece.SHAPE_ID_EMPTY, dtype=np.uint8)
+        self.current_shape_id = np.full(num_of_games, tpiece.SHAPE_ID_EMPTY, dtype=np.int32)
+        self.next_shape_id = np.full(num_of_games, tpiece.SHAPE_ID_EMPTY, dtype=np.int32)
+        self.rotation = np.zeros(num_of_games, dtype=np.int32)
+        self.origin_row = np.zeros(num_of_games, dtype=np.int32)
+        self.origin_col = np.zeros(num_of_games, dtype=np.int32)
+
+        self.running_game = np.zeros(num_of_games, dtype=bool)
+        self.num_of_pieces_placed = np.zeros(num_of_games, dtype=np.int64)
+        self.num_of_rows_cleared = np.zeros(num_of_games, dtype=np.int64)
+        self.num_of_holes = np.zeros(num_of_games, dtype=np.int64)
+        self.max_height_of_stacked_pieces = np.zeros(num_of_games, dtype=np.int64)
+
+    def setup_new_game(self, games=None):
+        # Starts a new game on every board, or only on the boards selected
+        # by the boolean mask games.
+        if games is None:
+            games = np.ones(self.num_of_games, dtype=bool)
+        count = int(games.sum())
+        self.board[games] = tpiece.SHAPE_ID_EMPTY
+        self.current_shape_id[games] = self.draw_shapes(games)
+        self.next_shape_id[games] = self.draw_shapes(games)
+        self.num_of_pieces_placed[games] = 0
+        self.num_of_rows_cleared[games] = 0
+        self.num_of_holes[games] = 0
+        self.max_height_of_stacked_pieces[games] = 0
+        self.running_game[games] = True
+        self.place_new_current_pieces(games)
+
+    def draw_shapes(self, games):
+        if self.piece_generators is None:
+            return self.rng.integers(0, tgame.NUM_OF_SHAPES, size=int(games.sum()))
+        return [self.piece_generators[i].next() for i in np.flatnonzero(games)]
+
+    def get_piece_cells(self, shape_ids, rotations, rows, cols):
+        offsets = self.STATES_ALL[shape_ids, rotations]
+        return rows[:, None] + offsets[..., 0], cols[:, None] + offsets[..., 1]
+
+    def fits(self, shape_ids, rotations, rows, cols):
+        cell_rows, cell_cols = self.get_piece_cells(shape_ids, rotations, rows, cols)
+        inside = (cell_rows >= 0) & (cell_rows < self.num_of_rows) & \
+                 (cell_cols >= 0) & (cell_cols < self.num_of_columns)
+        games = np.arange(len(shape_ids))[:, None]
+        free = self.board[games,
+                          np.clip(cell_rows, 0, self.num_of_rows - 1),
+                          np.clip(cell_cols, 0, self.num_of_columns - 1)] == tpiece.SHAPE_ID_EMPTY
+        return (inside & free).all(axis=1)
+
+    def can_pieces_move(self, d_row, d_col):
+        return self.fits(self.current_shape_id, self.rotation, self.origin_row + d_row, self.origin_col + d_col)
+
+    def move_pieces(self, games, d_row, d_col):
+        can_move = games & self.can_pieces_move(d_row, d_col)
+        self.origin_row += can_move * d_row
+        self.origin_col += can_move * d_col
+        return can_move
+
+    def rotate_pieces(self, games, quarter_turns):
+        rotations = (self.rotation + quarter_turns) % 4
+        pending = games.copy()
+        for kick in range(self.MAX_NUM_OF_KICKS):
+            if not pending.any():
+                break
+            kicks = self.KICK_OFFSETS_ALL[self.current_shape_id, kick]
+            rows = self.origin_row + kicks[:, 0]
+            cols = self.origin_col + kicks[:, 1]
+            rotated = pending & self.fits(self.current_shape_id, rotations, rows, cols)
+            self.rotation = np.where(rotated, rotations, self.rotation)
+            self.origin_row = np.where(rotated, rows, self.origin_row)
+            self.origin_col = np.where(rotated, cols, self.origin_col)
+            pending &= ~rotated
+
+    def drop_pieces_to_bottom(self, games):
+        falling = games.copy()
+        while falling.any():
+            falling = self.move_pieces(falling, 1, 0)
+        self.pieces_have_reached_bottom(games)
+
+    def pieces_have_reached_bottom(self, games):
+        if not games.any():
+            return
+        index = np.flatnonzero(games)
+        cell_rows, cell_cols = self.get_piece_cells(self.current_shape_id[index], self.rotation[index],
+                                                    self.origin_row[index], self.origin_col[index])
+        self.board[index[:, None], cell_rows, cell_cols] = self.current_shape_id[index, None]
+        self.num_of_pieces_placed[index] += 1
+        self.remove_full_rows(index)
+        self.update_stats(index)
+        self.select_new_current_pieces(games)
+        self.place_new_current_pieces(games)
+
+    def remove_full_rows(self, index):
+        boards = self.board[index]
+        full_rows = (boards != tpiece.SHAPE_ID_EMPTY).all(axis=2)
+        # TetrisGame.remove_full_rows never clears the top row.
+        full_rows[:, 0] = False
+        num_of_full_rows = full_rows.sum(axis=1)
+        if not num_of_full_rows.any():
+            return
+        # Stable sort moves the full rows to the top and keeps the order of
+        # the others, then the rows that were full are emptied.
+        order = np.argsort(~full_rows, axis=1, kind='stable')
+        boards = np.take_along_axis(boards, order[:, :, None], axis=1)
+        boards[np.arange(self.num_of_rows)[None, :] < num_of_full_rows[:, None]] = tpiece.SHAPE_ID_EMPTY
+        self.board[index] = boards
+        self.num_of_rows_cleared[index] += num_of_full_rows
+
+    def update_stats(self, index):
+        occupied = self.board[index] != tpiece.SHAPE_ID_EMPTY
+        below_a_block = np.maximum.accumulate(occupied, axis=1)
+        self.num_of_holes[index] = (below_a_block & ~occupied).sum(axis=(1, 2))
+        column_heights = np.where(occupied.any(axis=1), self.num_of_rows - occupied.argmax(axis=1), 0)
+        self.max_height_of_stacked_pieces[index] = column_heights.max(axis=1)
+
+    def select_new_current_pieces(self, games):
+        self.current_shape_id[games] = self.next_shape_id[games]
+        self.next_shape_id[games] = self.draw_shapes(games)
+
+    def place_new_current_pieces(self, games):
+        self.rotation[games] = 0
+        self.origin_row[games] = self.SPAWN_ORIGIN_ALL[self.current_shape_id[games], 0]
+        self.origin_col[games] = self.SPAWN_ORIGIN_ALL[self.current_shape_id[games], 1]
+        self.running_game &= ~games | self.can_pieces_move(0, 0)
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        running = self.running_game
+        for action, d_row, d_col in self.MOVE_ACTIONS:
+            games = running & (actions == action)
+            if games.any():
+                self.move_pieces(games, d_row, d_col)
+        for action, quarter_turns in self.ROTATION_ACTIONS:
+            games = running & (actions == action)
+            if games.any():
+                self.rotate_pieces(games, quarter_turns)
+        games = running & (actions == tgame.ACTION_HARD_DROP)
+        if games.any():
+            self.drop_pieces_to_bottom(games)
+
+        running = self.running_game
+        self.pieces_have_reached_bottom(running & ~self.move_pieces(running, 1, 0))
+        return self.running_game
+
+def check_against_scalar(seeds, num_of_steps=2000, num_of_rows=20, num_of_columns=10):
+    # Plays one TetrisGame per seed next to a batch of the same games, with
+    # the same pieces and random actions, and compares them after every
+    # step. Returns the number of mismatching (step, game) pairs.
+    from sim_clock import SimulationClock
+    from piece_generator import UniformGenerator
+
+    games = [tgame(num_of_rows, num_of_columns, clock=SimulationClock(), verbose=False,
+                   piece_generator=UniformGenerator(seed)) for seed in seeds]
+    batch = BatchTetrisGame(len(seeds), num_of_rows, num_of_columns, seed=0,
+                            piece_generators=[UniformGenerator(seed) for seed in seeds])
+    for game in games:
+        game.setup_new_game()
+    batch.setup_new_game()
+    mismatches = 0
+    for step in range(num_of_steps):
+        actions = batch.rng.integers(0, tgame.NUM_OF_ACTIONS, size=len(seeds))
+        for game, action in zip(games, actions):
+            if game.running_game:
+                game.apply_action(int(action))
+            if game.running_game:
+                game.apply_gravity()
+        batch.step(actions)
+        for i, game in enumerate(games):
+            piece = game.current_piece
+            board = np.frombuffer(game.board.shape_ids, dtype=np.uint8).reshape(num_of_rows, num_of_columns)
+            if not (np.array_equal(board, batch.board[i])
+                    and game.running_game == batch.running_game[i]
+                    and game.current_shape_id == batch.current_shape_id[i]
+                    and game.next_shape_id == batch.next_shape_id[i]
+                    # A finished TetrisGame has no falling piece.
+                    and (not game.running_game
+                         or (piece.rotation, piece.origin_row, piece.origin_col)
+                         == (batch.rotation[i], batch.origin_row[i], batch.origin_col[i]))
+                    and game.num_of_pieces_placed == batch.num_of_pieces_placed[i]
+                    and game.num_of_rows_cleared == batch.num_of_rows_cleared[i]
+                    and game.num_of_holes == batch.num_of_holes[i]
+                    and game.max_height_of_stacked_pieces == batch.max_height_of_stacked_pieces[i]):
+                mismatches += 1
+        if not batch.running_game.any():
+            break
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check_against_scalar(range(20))
+    print('batch vs scalar games:', 'OK' if mismatches == 0 else f'{mismatches} mismatches')
+
+    batch = BatchTetrisGame(1000, seed=1)
+    batch.setup_new_game()
+    while batch.running_game.any():
+        batch.step(batch.rng.integers(0, tgame.NUM_OF_ACTIONS, size=batch.num_of_games))
+    print(batch.num_of_pieces_placed.mean(), batch.num_of_rows_cleared.mean())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmarks the TetrisGame primitives on seeded board fixtures, headless
+    games per second and TetrisUI frame times under the SDL dummy video
+    driver. Results are written as JSON and, given a baseline written by an
+    earlier run, compared against it:
+
+        python benchmark.py --output baseline.json
+        python benchmark.py --baseline baseline.json
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import random as rand
+from statistics import median
+from time import perf_counter
+
+from game import TetrisGame as tgame
+from sim_clock import SimulationClock
+from selfplay import play_game
+
+FIXTURE_SEED = 2024
+# Rows of random squares above the full rows of a fixture.
+FIXTURE_GARBAGE_ROWS = 8
+FIXTURE_GARBAGE_DENSITY = 0.6
+
+def make_board_fixture(num_of_full_rows=0, seed=FIXTURE_SEED, num_of_rows=20, num_of_columns=10):
+    # Game with num_of_full_rows full rows at the bottom and seeded random
+    # squares above them, all stats in sync, and the first piece at its
+    # spawn location.
+    game = tgame(num_of_rows, num_of_columns, clock=SimulationClock(), seed=seed, verbose=False)
+    game.setup_new_game()
+    rng = rand.Random(seed)
+    first_full_row = num_of_rows - num_of_full_rows
+    for row in range(first_full_row - FIXTURE_GARBAGE_ROWS, num_of_rows):
+        cells = [(row, col) for col in range(num_of_columns)
+                 if row >= first_full_row or rng.random() < FIXTURE_GARBAGE_DENSITY]
+        game.board.lock_cells(cells, rng.randrange(tgame.NUM_OF_SHAPES))
+    game.count_num_of_holes()
+    game.meassure_max_height()
+    game.board_hash = game.zobrist.hash_rows(game.board.masks, 0, num_of_rows - 1)
+    return game
+
+def time_calls(func, setup=None, number=1000, repeat=5):
+    # Seconds per call of func, one mean per repeat. With a setup, it runs
+    # untimed before every call so mutating calls start from the same state.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        results = []
+        for i in range(repeat):
+            if setup is None:
+                start = perf_counter()
+                for j in range(number):
+                    func()
+                results.append((perf_counter() - start) / number)
+            else:
+                total = 0.0
+                for j in range(number):
+                    setup()
+                    start = perf_counter()
+                    func()
+                    total += perf_counter() - start
+                results.append(total / number)
+        return results
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def summarize(results, unit='us', scale=1e6):
+    return {'median_' + unit: median(results) * scale, 'min_' + unit: min(results) * scale, 'repeat': len(results)}
+
+def bench_primitives(number, repeat):
+    results = {}
+    game = make_board_fixture()
+    snapshot = game.snapshot()
+    def restore():
+        game.restore(snapshot)
+
+    for name in ('can_current_piece_move_one_down', 'can_current_piece_move_one_left',
+                 'can_current_piece_move_one_right', 'count_num_of_holes'):
+        results[name] = summarize(time_calls(getattr(game, name), number=number, repeat=repeat))
+    for name in ('move_current_piece_one_down', 'move_current_piece_one_left', 'move_current_piece_one_right',
+                 'rotate_piece_clock_wise', 'drop_current_piece_to_bottom'):
+        results[name] = summarize(time_calls(getattr(game, name), restore, number, repeat))
+
+    for num_of_full_rows in range(1, 5):
+        game = make_board_fixture(num_of_full_rows)
+        snapshot = game.snapshot()
+        cells = [(game.num_of_rows - 1 - i, 0) for i in range(num_of_full_rows)]
+        results[f'remove_full_rows_{num_of_full_rows}'] = summarize(
+            time_calls(lambda: game.remove_full_rows(cells), lambda: game.restore(snapshot), number, repeat))
+    return results
+
+def bench_games(num_of_games, repeat):
+    # Random policy games, the same seeds every run.
+    games_per_sec = []
+    pieces_per_sec = []
+    for i in range(repeat):
+        start = perf_counter()
+        num_of_pieces = sum(play_game('random', seed)['pieces_placed'] for seed in range(num_of_games))
+        wall_time = perf_counter() - start
+        games_per_sec.append(num_of_games / wall_time)
+        pieces_per_sec.append(num_of_pieces / wall_time)
+    return {'headless_games': {'median_games_per_sec': median(games_per_sec),
+                               'median_pieces_per_sec': median(pieces_per_sec),
+                               'repeat': repeat}}
+
+def bench_ui(num_of_frames, repeat):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    from UI import TetrisUI
+
+    ui = TetrisUI()
+    ui.game_logic.verbose = False
+    ui.new_game = False
+    actions = rand.Random(FIXTURE_SEED)
+    def setup_frame():
+        # One input and a few ticks of gravity, restarting on game over.
+        if not ui.game_logic.running_game:
+            ui.init_game()
+        ui.game_logic.step(actions.randrange(tgame.NUM_OF_ACTIONS), 4)
+    def full_frame():
+        ui.draw_screen_layout()
+        ui.update_display()
+
+    ui.game_logic.setup_new_game(FIXTURE_SEED)
+    ui.init_game()
+    ui.update_display()
+    return {'ui_frame': summarize(time_calls(ui.render, setup_frame, num_of_frames, repeat)),
+            'ui_full_frame': summarize(time_calls(full_frame, setup_frame, num_of_frames // 10 or 1, repeat))}
+
+def run(args):
+    results = bench_primitives(args.number, args.repeat)
+    results.update(bench_games(args.games, args.repeat))
+    if not args.skip_ui:
+        results.update(bench_ui(args.frames, args.repeat))
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results}
+
+def compare(results, baseline, threshold):
+    # Prints the slowdown of every benchmark, above 1 is slower, and
+    # returns the names that got slower than threshold allows.
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        for key, value in result.items():
+            if not key.startswith('median_'):
+                continue
+            base_value = baseline['results'][name][key]
+            # Rates get better when they grow, times when they shrink.
+            slowdown = base_value / value if key.endswith('_per_sec') else value / base_value
+            flag = ' REGRESSION' if slowdown > threshold else ''
+            print(f'{name:40s} {key:24s} {base_value:12.3f} -> {value:12.3f} {slowdown:5.2f}x{flag}', file=sys.stderr)
+            if flag:
+                regressions.append(name)
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Tetris engine and renderer.')
+    parser.add_argument('--number', type=int, default=2000, help='calls per repeat of every primitive')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats of every benchmark')
+    parser.add_argument('--games', type=int, default=50, help='headless games per repeat')
+    parser.add_argument('--frames', type=int, default=500, help='UI frames per repeat')
+    parser.add_argument('--skip-ui', action='store_true', help='do not benchmark the UI')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown against the baseline reported as a regression')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print('')
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+from pieces import TetrisPiece as tpiece
+
+class BitBoard(object):
+    '''
+        Stores the locked squares of the playing field as one integer bitmask
+        per row (bit n is column n) together with the shape id of every square.
+    '''
+    def __init__(self, num_of_rows=20, num_of_columns=10):
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.full_row_mask = (1 << num_of_columns) - 1
+        self.masks = []
+        self.shape_ids = bytearray()
+        self.clear()
+
+    def clear(self):
+        # shape_ids is emptied in place, views of it stay valid.
+        self.masks = [0] * self.num_of_rows
+        num_of_squares = self.num_of_rows * self.num_of_columns
+        if len(self.shape_ids) == num_of_squares:
+            self.shape_ids[:] = bytes([tpiece.SHAPE_ID_EMPTY]) * num_of_squares
+        else:
+            self.shape_ids = bytearray([tpiece.SHAPE_ID_EMPTY]) * num_of_squares
+
+    def copy(self):
+        board = BitBoard.__new__(BitBoard)
+        board.num_of_rows = self.num_of_rows
+        board.num_of_columns = self.num_of_columns
+        board.full_row_mask = self.full_row_mask
+        board.masks = self.masks[:]
+        board.shape_ids = self.shape_ids[:]
+        return board
+
+    def load_shape_ids(self, shape_ids):
+        # Replaces the board with rows * cols shape ids and rebuilds the
+        # masks from them.
+        cols = self.num_of_columns
+        self.shape_ids[:] = shape_ids
+        for row in range(self.num_of_rows):
+            row_mask = 0
+            for col, shape_id in enumerate(self.shape_ids[row * cols:(row + 1) * cols]):
+                if not shape_id == tpiece.SHAPE_ID_EMPTY:
+                    row_mask |= 1 << col
+            self.masks[row] = row_mask
+
+    def is_occupied(self, row, col):
+        return (self.masks[row] >> col) & 1 == 1
+
+    def get_shape_id(self, row, col):
+        return self.shape_ids[row * self.num_of_columns + col]
+
+    def is_row_full(self, row):
+        return self.masks[row] == self.full_row_mask
+
+    def fits(self, offsets, origin_row, origin_col):
+        for d_row, d_col in offsets:
+            row = origin_row + d_row
+            col = origin_col + d_col
+            if not 0 <= row < self.num_of_rows or not 0 <= col < self.num_of_columns:
+                return False
+            if (self.masks[row] >> col) & 1:
+                return False
+        return True
+
+    def lock_cells(self, cells, shape_id):
+        for row, col in cells:
+            self.masks[row] |= 1 << col
+            self.shape_ids[row * self.num_of_columns + col] = shape_id
+
+    def remove_rows(self, rows):
+        # Removes the given rows in one pass. The rows above the lowest one
+        # that are kept move down as whole rows, the freed rows at the top
+        # are emptied.
+        cols = self.num_of_columns
+        last_row = max(rows)
+        kept_rows = [row for row in range(last_row + 1) if row not in rows]
+        num_of_removed = last_row + 1 - len(kept_rows)
+        self.masks[:last_row + 1] = [0] * num_of_removed + [self.masks[row] for row in kept_rows]
+        self.shape_ids[:(last_row + 1) * cols] = bytes([tpiece.SHAPE_ID_EMPTY]) * (num_of_removed * cols) + \
+            b''.join(self.shape_ids[row * cols:(row + 1) * cols] for row in kept_rows)
+
+
+class GridView(object):
+    '''
+        Read only grid[row][col] view of a TetrisGame. The GridSquare objects
+        are created on access, nothing is stored.
+    '''
+    def __init__(self, game):
+        self.game = game
+
+    def __len__(self):
+        return self.game.num_of_rows
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.game.num_of_rows
+        if not 0 <= row < self.game.num_of_rows:
+            raise IndexError('grid row index out of range')
+        return GridRowView(self.game, row)
+
+
+class GridRowView(object):
+    def __init__(self, game, row):
+        self.game = game
+        self.row = row
+
+    def __len__(self):
+        return self.game.num_of_columns
+
+    def __getitem__(self, col):
+        if col < 0:
+            col += self.game.num_of_columns
+        if not 0 <= col < self.game.num_of_columns:
+            raise IndexError('grid column index out of range')
+        return self.game.get_square(self.row, col)
+
+
+if __name__ == '__main__':
+    b = BitBoard()
+    b.lock_cells([(19, col) for col in range(10)], tpiece.SHAPE_ID_I)
+    print(b.is_row_full(19))
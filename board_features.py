@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+'''
+    Board features of many positions at once, with NumPy. Boards are stacked
+    (N, rows, cols) occupancy arrays, anything non-zero is a square. The
+    helpers below build them from BitBoard row masks, shape ids, or one board
+    and a list of placements.
+
+    Heights and holes follow the TetrisGame column stats: the height of a
+    column is num_of_rows minus the row of its top square, 0 if empty, and a
+    hole is an empty square below the top square of its column. The other
+    features match ai_player.get_features().
+'''
+
+import numpy as np
+
+from pieces import TetrisPiece as tpiece
+
+def masks_to_occupancy(masks, num_of_columns):
+    # (N, rows) BitBoard row masks, column 0 in the lowest bit.
+    masks = np.asarray(masks, dtype=np.int64)
+    return (masks[..., None] >> np.arange(num_of_columns)) & 1 == 1
+
+def boards_to_occupancy(boards):
+    return masks_to_occupancy([board.masks for board in boards], boards[0].num_of_columns)
+
+def shape_ids_to_occupancy(shape_ids):
+    # Shape ids as in BitBoard.shape_ids, TetrisEnv observations or
+    # ShardRecorder records.
+    return np.asarray(shape_ids) != tpiece.SHAPE_ID_EMPTY
+
+def lock_placements(occupancy, placements):
+    # One board per placement: the (rows, cols) board with the cells of the
+    # placement, [(row, col), ...], locked. Returns the boards and the
+    # squares of the pieces alone, both (N, rows, cols).
+    num_of_cells = len(placements[0])
+    cells = np.asarray(placements, dtype=np.intp).reshape(len(placements), num_of_cells, 2)
+    index = np.repeat(np.arange(len(placements)), num_of_cells)
+    pieces = np.zeros((len(placements),) + occupancy.shape, dtype=bool)
+    pieces[index, cells[..., 0].ravel(), cells[..., 1].ravel()] = True
+    return pieces | (np.asarray(occupancy) != 0), pieces
+
+def get_full_rows(occupancy):
+    # (N, rows) bool. The top row is never cleared, like in TetrisGame.
+    full_rows = np.asarray(occupancy).all(axis=2)
+    full_rows[:, 0] = False
+    return full_rows
+
+def clear_full_rows(occupancy, full_rows=None):
+    # Boards with the full rows removed and the rows above moved down, and
+    # the number of removed rows per board.
+    occupancy = np.asarray(occupancy) != 0
+    if full_rows is None:
+        full_rows = get_full_rows(occupancy)
+    num_of_cleared = full_rows.sum(axis=1)
+    clearing = np.flatnonzero(num_of_cleared)
+    if not len(clearing):
+        return occupancy, num_of_cleared
+    # Stable sort puts the full rows on top and keeps the order of the rest,
+    # then the full rows are emptied.
+    order = np.argsort(~full_rows[clearing], axis=1, kind='stable')
+    moved = np.take_along_axis(occupancy[clearing], order[..., None], axis=1)
+    moved &= (np.arange(occupancy.shape[1]) >= num_of_cleared[clearing, None])[..., None]
+    cleared = occupancy.copy()
+    cleared[clearing] = moved
+    return cleared, num_of_cleared
+
+def get_features(occupancy, pieces=None):
+    '''
+        Dict of feature arrays for (N, rows, cols) boards:
+
+            column_heights, column_holes    (N, cols)
+            holes, max_height, aggregate_height, bumpiness, wells,
+            row_transitions, column_transitions     (N,)
+
+        With pieces, the squares of the last locked piece of every board as
+        from lock_placements(), the full rows are cleared first and
+        rows_cleared and eroded_cells (rows cleared times the squares of the
+        piece in them) are added.
+    '''
+    filled = np.asarray(occupancy) != 0
+    num_of_boards, num_of_rows, num_of_columns = filled.shape
+    features = {}
+    if pieces is not None:
+        full_rows = get_full_rows(filled)
+        filled, rows_cleared = clear_full_rows(filled, full_rows)
+        pieces_cleared = (np.asarray(pieces) & full_rows[..., None]).sum(axis=(1, 2))
+        features['rows_cleared'] = rows_cleared
+        features['eroded_cells'] = rows_cleared * pieces_cleared
+
+    # Every square from the top square of a column down is either filled
+    # or a hole.
+    top_rows = filled.argmax(axis=1)
+    column_heights = np.where(filled.any(axis=1), num_of_rows - top_rows, 0)
+    column_holes = column_heights - filled.sum(axis=1)
+    features['column_heights'] = column_heights
+    features['column_holes'] = column_holes
+    features['holes'] = column_holes.sum(axis=1)
+    features['max_height'] = column_heights.max(axis=1)
+    features['aggregate_height'] = column_heights.sum(axis=1)
+    features['bumpiness'] = np.abs(np.diff(column_heights, axis=1)).sum(axis=1)
+
+    # Depth below the lower neighbour, the walls count as full columns.
+    walls = np.full((num_of_boards, 1), num_of_rows)
+    walled_heights = np.concatenate((walls, column_heights, walls), axis=1)
+    depths = np.minimum(walled_heights[:, :-2], walled_heights[:, 2:]) - column_heights
+    features['wells'] = np.maximum(depths, 0).sum(axis=1)
+
+    # Filled/empty changes along every row from the top of the stack down,
+    # the walls count as filled, and down every column, the floor counts as
+    # filled.
+    walled = np.pad(filled, ((0, 0), (0, 0), (1, 1)), constant_values=True)
+    row_transitions = (walled[:, :, 1:] != walled[:, :, :-1]).sum(axis=2)
+    stack_rows = np.arange(num_of_rows) >= num_of_rows - features['max_height'][:, None]
+    features['row_transitions'] = (row_transitions * stack_rows).sum(axis=1)
+    floored = np.pad(filled, ((0, 0), (0, 1), (0, 0)), constant_values=True)
+    features['column_transitions'] = (floored[:, 1:] != floored[:, :-1]).sum(axis=(1, 2))
+    return features
+
+def check_features(seeds, placement_stride=7):
+    # Compares get_features() with the column stats of TetrisGame and with
+    # ai_player on the boards of random games, and on every drop placement
+    # of every shape on every placement_stride-th of them and on random
+    # stacks of rows full but a few squares, which clear rows often. Returns
+    # the number of mismatching boards and placements.
+    import random as rand
+    from game import TetrisGame as tgame
+    from sim_clock import SimulationClock
+    import ai_player
+
+    boards = []
+    mismatches = 0
+    for seed in seeds:
+        game = tgame(clock=SimulationClock(), seed=seed, verbose=False)
+        game.setup_new_game()
+        rng = rand.Random(seed)
+        while game.running_game:
+            game.step(rng.randrange(tgame.NUM_OF_ACTIONS), rng.randrange(1, 6))
+            masks = game.board.masks[:]
+            features = get_features(masks_to_occupancy([masks], game.num_of_columns))
+            reference = ai_player.get_features(masks, game.num_of_columns)
+            if not (features['column_heights'][0].tolist() == game.column_heights
+                    and features['column_holes'][0].tolist() == game.column_holes
+                    and features['holes'][0] == game.num_of_holes
+                    and features['max_height'][0] == game.max_height_of_stacked_pieces
+                    and all(features[name][0] == value for name, value in reference.items())):
+                mismatches += 1
+            boards.append(masks)
+
+    num_of_rows = game.num_of_rows
+    num_of_columns = game.num_of_columns
+    full_row_mask = (1 << num_of_columns) - 1
+    boards = boards[::placement_stride]
+    for seed in seeds:
+        rng = rand.Random(seed)
+        for i in range(num_of_rows):
+            height = rng.randrange(num_of_rows + 1)
+            masks = [0] * (num_of_rows - height)
+            for row in range(height):
+                width = rng.randrange(1, 5)
+                gap = ((1 << width) - 1) << rng.randrange(num_of_columns - width + 1)
+                masks.append(full_row_mask & ~gap if rng.random() < 0.8 else rng.getrandbits(num_of_columns))
+            boards.append(masks)
+    for masks in boards:
+        placements = [cells for shape_id in range(tgame.NUM_OF_SHAPES)
+                      for cells in ai_player.get_drop_placements(masks, num_of_columns, shape_id)]
+        if not placements:
+            continue
+        locked, pieces = lock_placements(masks_to_occupancy([masks], num_of_columns)[0], placements)
+        features = get_features(locked, pieces)
+        for i, cells in enumerate(placements):
+            child, num_of_cleared = ai_player.lock_and_clear(masks, cells, num_of_columns)
+            reference = ai_player.get_features(child, num_of_columns)
+            locked_masks = masks[:]
+            for row, col in cells:
+                locked_masks[row] |= 1 << col
+            eroded_cells = num_of_cleared * sum(1 for row, col in cells
+                                                if row > 0 and locked_masks[row] == full_row_mask)
+            if not (features['rows_cleared'][i] == num_of_cleared
+                    and features['eroded_cells'][i] == eroded_cells
+                    and all(features[name][i] == value for name, value in reference.items())):
+                mismatches += 1
+    return mismatches
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    from game import TetrisGame as tgame
+    from sim_clock import SimulationClock
+    from ai_player import get_drop_placements
+
+    mismatches = check_features(range(20))
+    print('features vs TetrisGame and ai_player:', 'OK' if mismatches == 0 else f'{mismatches} mismatches')
+
+    # Every drop placement of every shape on a mid game board.
+    game = tgame(clock=SimulationClock(), seed=0, verbose=False)
+    game.setup_new_game()
+    while game.running_game and game.num_of_pieces_placed < 30:
+        game.step(game.num_of_pieces_placed % tgame.NUM_OF_ACTIONS, 10)
+    board = masks_to_occupancy([game.board.masks], game.num_of_columns)[0]
+    placements = [cells for shape_id in range(tgame.NUM_OF_SHAPES)
+                  for cells in get_drop_placements(game.board.masks, game.num_of_columns, shape_id)] * 500
+    start = perf_counter()
+    boards, pieces = lock_placements(board, placements)
+    features = get_features(boards, pieces)
+    wall_time = perf_counter() - start
+    print(f'{len(placements)} placements in {wall_time * 1e3:.1f} ms, '
+          f'{len(placements) / wall_time:.0f} placements/s')
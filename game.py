@@ -2,10 +2,18 @@
 
 from grid_square import GridSquare as gsquare
 from pieces import TetrisPiece as tpiece
+from bitboard import BitBoard, GridView
+from active_piece import ActivePiece
+from rotation_table import RotationTable as rtable
+from sim_clock import SimulationClock
+from placement import Placement
+from zobrist import get_zobrist_table
+from piece_generator import UniformGenerator
 
 from time import time
-import random as rand
-from math import cos, sin, pi
+from collections import deque
+from dataclasses import replace
+import struct
 
 class TetrisGame(object):
 
@@ -15,288 +23,525 @@ class TetrisGame(object):
 
     NUM_OF_SHAPES           = 7
 
-    def __init__(self, num_of_rows=20, num_of_columns=10):
+    # Actions accepted by apply_action() and step().
+    ACTION_NONE             = 0
+    ACTION_LEFT             = 1
+    ACTION_RIGHT            = 2
+    ACTION_DOWN             = 3
+    ACTION_ROTATE_CW        = 4
+    ACTION_ROTATE_CCW       = 5
+    ACTION_ROTATE_180       = 6
+    ACTION_HARD_DROP        = 7
+    NUM_OF_ACTIONS          = 8
+
+    # snapshot() blob: this header, then the shape ids of the board, the
+    # column heights and holes and the last cleared rows.
+    SNAPSHOT_MAGIC          = b'TSNP'
+    SNAPSHOT_VERSION        = 2
+    SNAPSHOT_HEADER         = struct.Struct('<4sBHHbBhhqbb?qqqqQdddBqQI')
+
+    # Methods timed when a Profiler is handed in.
+    PROFILED_METHODS        = ('update_timers', 'remove_full_rows', 'update_column_stats', 'rebase_column_stats')
+    # Methods ShardRecorder hooks into.
+    RECORDED_METHODS        = ('step', 'current_piece_has_reached_bottom')
+
+    def __init__(self, num_of_rows=20, num_of_columns=10, clock=time, seed=None, verbose=True, profiler=None,
+                 piece_generator=None):
         self.num_of_rows = num_of_rows
         self.num_of_columns = num_of_columns
-        self.grid = []
+        self.board = BitBoard(num_of_rows, num_of_columns)
+        self.zobrist = get_zobrist_table(num_of_rows, num_of_columns)
+        self.current_piece = ActivePiece()
         self.empty_grid()
 
         self.current_piece_id = tpiece.PIECE_ID_EMPTY
-        self.current_piece_rotation_center = (0, 0)
         self.current_shape_id = tpiece.SHAPE_ID_EMPTY
         self.next_shape_id = tpiece.SHAPE_ID_EMPTY
 
         self.running_game = False
+        self.verbose = verbose
 
+        self.num_of_pieces_placed = 0
         self.num_of_rows_cleared = 0
         self.num_of_holes = 0
         self.max_height_of_stacked_pieces = 0
+        # Rows removed by the last locked piece, numbered as before removal.
+        self.last_cleared_rows = []
 
-        self.fall_freq = self.FALL_SPEED_INIT
-        self.timer_speed_update_start = time()
-        self.timer_speed_update_end = time()
-        self.timer_piece_fall_start = time()
-        self.timer_piece_fall_end = time()
+        # Wall clock by default, a SimulationClock for headless games.
+        self.clock = clock
+        self.seed = seed
+        # Source of the shapes, see piece_generator.py.
+        self.piece_generator = UniformGenerator(seed) if piece_generator is None else piece_generator
 
-    def setup_new_game(self):
+        self.fall_freq = self.FALL_SPEED_INIT
+        self.timer_speed_update_start = self.clock()
+        self.timer_speed_update_end = self.clock()
+        self.timer_piece_fall_start = self.clock()
+        self.timer_piece_fall_end = self.clock()
+
+        # ReplayRecorder that every step() is reported to, if any.
+        self.recorder = None
+
+        self.profiler = profiler
+        if profiler:
+            profiler.instrument(self, self.PROFILED_METHODS)
+
+    def setup_new_game(self, seed=None):
+        if seed is not None:
+            self.seed = seed
+            self.piece_generator.reset(seed)
         self.running_game = True
         self.empty_grid()
         self.current_piece_id = 1
-        self.current_shape_id = rand.randint(0, self.NUM_OF_SHAPES - 1)
-        self.next_shape_id = rand.randint(0, self.NUM_OF_SHAPES - 1)
-        self.current_piece_rotation_center = tpiece.DEFAULT_ROTATION_CENTER_ALL[self.current_shape_id]
+        self.current_shape_id = self.piece_generator.next()
+        self.next_shape_id = self.piece_generator.next()
         self.place_new_current_piece()
+        self.fall_freq = self.FALL_SPEED_INIT
         self.reset_all_timers()
+        self.num_of_pieces_placed = 0
         self.num_of_rows_cleared = 0
         self.num_of_holes = 0
         self.max_height_of_stacked_pieces = 0
+        self.last_cleared_rows = []
+
+    @property
+    def grid(self):
+        return GridView(self)
 
     def empty_grid(self):
-        self.grid = []
-        for row in range(self.num_of_rows):
-            temp_row = []
-            for col in range(self.num_of_columns):        
-                temp_row.append(gsquare(row, col))
-            self.grid.append(temp_row)
+        self.board.clear()
+        self.current_piece = ActivePiece()
+        # Height and number of holes of every column, kept up to date on
+        # every lock and line clear.
+        self.column_heights = [0] * self.num_of_columns
+        self.column_holes = [0] * self.num_of_columns
+        # Zobrist hash of the locked squares.
+        self.board_hash = 0
+
+    @property
+    def zobrist_hash(self):
+        return self.board_hash ^ self.zobrist.hash_shapes(self.current_shape_id, self.next_shape_id)
+
+    def snapshot(self):
+        # Packs the whole game state into bytes, e.g. to go back to after a
+        # search or as a save game. Timers are stored relative to the clock.
+        piece = self.current_piece
+        now = self.clock()
+        header = self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, 
+                                           self.num_of_rows, self.num_of_columns,
+                                           piece.shape_id, piece.rotation, piece.origin_row, piece.origin_col,
+                                           self.current_piece_id, self.current_shape_id, self.next_shape_id, 
+                                           self.running_game, self.num_of_pieces_placed, self.num_of_rows_cleared, 
+                                           self.num_of_holes, self.max_height_of_stacked_pieces, self.board_hash,
+                                           self.fall_freq, self.timer_speed_update_start - now, 
+                                           self.timer_piece_fall_start - now, len(self.last_cleared_rows),
+                                           *self.piece_generator.get_state())
+        column_stats = struct.pack(f'<{2 * self.num_of_columns + len(self.last_cleared_rows)}H', 
+                                   *self.column_heights, *self.column_holes, *self.last_cleared_rows)
+        return b''.join((header, self.board.shape_ids, column_stats))
+
+    def restore(self, snapshot):
+        # Inverse of snapshot(), on a game with the same board size and the
+        # same kind of piece generator.
+        header = self.SNAPSHOT_HEADER.unpack_from(snapshot)
+        magic, version, num_of_rows, num_of_columns = header[:4]
+        if not magic == self.SNAPSHOT_MAGIC or not version == self.SNAPSHOT_VERSION:
+            raise ValueError("not a snapshot of this version")
+        if not (num_of_rows, num_of_columns) == (self.num_of_rows, self.num_of_columns):
+            raise ValueError(f"snapshot board size ({num_of_rows}x{num_of_columns}) does not match "
+                             f"({self.num_of_rows}x{self.num_of_columns})")
+        (shape_id, rotation, origin_row, origin_col,
+         self.current_piece_id, self.current_shape_id, self.next_shape_id, self.running_game, 
+         self.num_of_pieces_placed, self.num_of_rows_cleared, self.num_of_holes, self.max_height_of_stacked_pieces, 
+         self.board_hash, self.fall_freq, timer_speed_update_offset, timer_piece_fall_offset, 
+         num_of_last_cleared_rows) = header[4:21]
+        self.piece_generator.set_state(header[21:])
+
+        pos = self.SNAPSHOT_HEADER.size
+        num_of_squares = num_of_rows * num_of_columns
+        self.board.load_shape_ids(snapshot[pos:pos + num_of_squares])
+        pos += num_of_squares
+        column_stats = struct.unpack_from(f'<{2 * num_of_columns + num_of_last_cleared_rows}H', snapshot, pos)
+        self.column_heights = list(column_stats[:num_of_columns])
+        self.column_holes = list(column_stats[num_of_columns:2 * num_of_columns])
+        self.last_cleared_rows = list(column_stats[2 * num_of_columns:])
+
+        if shape_id == tpiece.SHAPE_ID_EMPTY:
+            self.current_piece = ActivePiece()
+        else:
+            self.current_piece = ActivePiece(shape_id, rotation, origin_row, origin_col, 
+                                             rtable.STATES_ALL[shape_id][rotation])
+        now = self.clock()
+        self.timer_speed_update_start = now + timer_speed_update_offset
+        self.timer_speed_update_end = now
+        self.timer_piece_fall_start = now + timer_piece_fall_offset
+        self.timer_piece_fall_end = now
+
+    def clone(self):
+        # Copy to search on. Only the state that changes during play is
+        # copied, the rotation and Zobrist tables, the offsets of the piece
+        # and the pre-generated pieces are shared. A SimulationClock is
+        # copied, a wall clock shared.
+        game = object.__new__(type(self))
+        game.__dict__.update(self.__dict__)
+        game.board = self.board.copy()
+        game.current_piece = replace(self.current_piece)
+        game.column_heights = self.column_heights[:]
+        game.column_holes = self.column_holes[:]
+        game.last_cleared_rows = self.last_cleared_rows[:]
+        game.piece_generator = self.piece_generator.copy()
+        if isinstance(self.clock, SimulationClock):
+            game.clock = SimulationClock(self.clock.ticks_per_sec)
+            game.clock.ticks = self.clock.ticks
+        game.recorder = None
+        for name in self.RECORDED_METHODS:
+            game.__dict__.pop(name, None)
+        if self.profiler:
+            # The timed methods are bound to this game.
+            for name in self.PROFILED_METHODS:
+                del game.__dict__[name]
+            self.profiler.instrument(game, self.PROFILED_METHODS)
+        return game
+
+    def get_preview(self, count):
+        # The next count shapes, starting with next_shape_id.
+        if count <= 0:
+            return []
+        return [self.next_shape_id] + self.piece_generator.peek(count - 1)
+
+    def get_square(self, row, col):
+        if (row, col) in self.current_piece.cells():
+            return gsquare(row, col, False, self.current_piece_id, self.current_shape_id)
+        if self.board.is_occupied(row, col):
+            return gsquare(row, col, False, tpiece.PIECE_ID_LOCKED, self.board.get_shape_id(row, col))
+        return gsquare(row, col)
+
+    def get_current_piece_location(self):
+        # List of [row, col] for every square of the current piece.
+        return [[row, col] for row, col in self.current_piece.cells()]
 
     def select_new_current_piece(self):
         self.current_piece_id += 1
         self.current_shape_id = self.next_shape_id
-        self.current_piece_rotation_center = tpiece.DEFAULT_ROTATION_CENTER_ALL[self.current_shape_id]
-        self.next_shape_id = rand.randint(0, self.NUM_OF_SHAPES - 1)
+        self.next_shape_id = self.piece_generator.next()
 
     def can_new_piece_be_placed(self):
         for coordinate in tpiece.SPAWN_LOCATION_ALL[self.current_shape_id]:
-            if not self.grid[coordinate[0]][coordinate[1]].piece_id == tpiece.PIECE_ID_EMPTY:
+            if self.board.is_occupied(coordinate[0], coordinate[1]):
                 return False
         return True
     
     def place_new_current_piece(self):
-        for coordinate in tpiece.SPAWN_LOCATION_ALL[self.current_shape_id]:
-            self.grid[coordinate[0]][coordinate[1]].empty = False
-            self.grid[coordinate[0]][coordinate[1]].piece_id = self.current_piece_id
-            self.grid[coordinate[0]][coordinate[1]].shape_id = self.current_shape_id
-        self.current_piece_rotation_center = tpiece.DEFAULT_ROTATION_CENTER_ALL[self.current_shape_id]
+        self.current_piece = ActivePiece.spawn(self.current_shape_id)
+
+    def can_current_piece_move(self, d_row, d_col):
+        piece = self.current_piece
+        return self.board.fits(piece.offsets, piece.origin_row + d_row, piece.origin_col + d_col)
 
     def can_current_piece_move_one_down(self):
-        for row in range(self.num_of_rows - 1, -1, -1):
-            for col in range(self.num_of_columns - 1, -1, -1):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    if row == self.num_of_rows - 1:
-                        return False
-                    elif not self.grid[row + 1][col].empty and not self.grid[row + 1][col].piece_id == self.current_piece_id:
-                        return False
-        return True
+        return self.can_current_piece_move(1, 0)
     
     def can_current_piece_move_one_left(self):
-        for row in range(self.num_of_rows - 1, -1, -1):
-            for col in range(0, self.num_of_columns):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    if col == 0:
-                        return False
-                    elif not self.grid[row][col - 1].empty and not self.grid[row][col - 1].piece_id == self.current_piece_id:
-                        return False
-        return True
+        return self.can_current_piece_move(0, -1)
 
     def can_current_piece_move_one_right(self):
-        for row in range(self.num_of_rows - 1, -1, -1):
-            for col in range(self.num_of_columns - 1, -1, -1):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    if col == self.num_of_columns - 1:
-                        return False
-                    elif not self.grid[row][col + 1].empty and not self.grid[row][col + 1].piece_id == self.current_piece_id:
-                        return False
-        return True
+        return self.can_current_piece_move(0, 1)
 
     def move_current_piece_one_down(self):
-        for row in range(self.num_of_rows - 2, -1, -1):
-            for col in range(self.num_of_columns - 1, -1, -1):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    self.grid[row + 1][col].empty = False
-                    self.grid[row + 1][col].piece_id = self.current_piece_id
-                    self.grid[row + 1][col].shape_id = self.current_shape_id
-                    self.grid[row][col].empty = True
-                    self.grid[row][col].piece_id = tpiece.PIECE_ID_EMPTY
-                    self.grid[row][col].shape_id = tpiece.SHAPE_ID_EMPTY
-        self.current_piece_rotation_center = (self.current_piece_rotation_center[0] + 1, self.current_piece_rotation_center[1])
+        self.current_piece.origin_row += 1
 
     def move_current_piece_one_left(self):
         if not self.can_current_piece_move_one_left():
             return
-        for row in range(self.num_of_rows - 1, -1, -1):
-            for col in range(1, self.num_of_columns):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    self.grid[row][col - 1].empty = False
-                    self.grid[row][col - 1].piece_id = self.current_piece_id
-                    self.grid[row][col - 1].shape_id = self.current_shape_id
-                    self.grid[row][col].empty = True
-                    self.grid[row][col].piece_id = tpiece.PIECE_ID_EMPTY
-                    self.grid[row][col].shape_id = tpiece.SHAPE_ID_EMPTY
-        self.current_piece_rotation_center = (self.current_piece_rotation_center[0], self.current_piece_rotation_center[1] - 1)
+        self.current_piece.origin_col -= 1
 
     def move_current_piece_one_right(self):
         if not self.can_current_piece_move_one_right():
             return
-        for row in range(self.num_of_rows - 1, -1, -1):
-            for col in range(self.num_of_columns - 2, -1, -1):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    self.grid[row][col + 1].empty = False
-                    self.grid[row][col + 1].piece_id = self.current_piece_id
-                    self.grid[row][col + 1].shape_id = self.current_shape_id
-                    self.grid[row][col].empty = True
-                    self.grid[row][col].piece_id = tpiece.PIECE_ID_EMPTY
-                    self.grid[row][col].shape_id = tpiece.SHAPE_ID_EMPTY
-        self.current_piece_rotation_center = (self.current_piece_rotation_center[0], self.current_piece_rotation_center[1] + 1)    
+        self.current_piece.origin_col += 1
     
-    def rotate_piece_clock_wise(self):
-        current_piece_location = []
-        for row in range(self.num_of_rows):
-            for col in range(self.num_of_columns):
-                if self.grid[row][col].piece_id == self.current_piece_id:
-                    current_piece_location.append(self.grid[row][col])
-
-        rotated_piece = []
-        for i in range(4):
-            rotated_piece.append(self.rotate_single_square_around_rotation_point(current_piece_location[i], self.current_piece_rotation_center))
-
-        # Check for boundry conditions:
-        move_left = 0
-        move_right = 0
-        for i in range(len(rotated_piece)):
-            if rotated_piece[i][0] < 0:
-                move_right += 1
-            elif rotated_piece[i][0] >= self.num_of_columns:
-                move_left += 1
-        
-        if move_left > 0 and move_right > 0:
-            print('Error: Can\'t move left and right at the same time....')
-        elif move_left > 0:
-            self.current_piece_rotation_center = (self.current_piece_rotation_center[0], self.current_piece_rotation_center[1] - move_left)
-            for i in range(len(rotated_piece)):
-                rotated_piece[i][0] -= move_left
-        elif move_right > 0:
-            self.current_piece_rotation_center = (self.current_piece_rotation_center[0], self.current_piece_rotation_center[1] + move_right)
-            for i in range(len(rotated_piece)):
-                rotated_piece[i][0] += move_right
-
-        can_be_rotated = True
-        for i in range(len(rotated_piece)):
-            if not self.grid[rotated_piece[i][1]][rotated_piece[i][0]].empty and not self.grid[rotated_piece[i][1]][rotated_piece[i][0]].piece_id == self.current_piece_id:
-                can_be_rotated = False
-
-        if can_be_rotated:
-            for i in range(len(rotated_piece)):
-                self.grid[current_piece_location[i].row][current_piece_location[i].col].empty = True
-                self.grid[current_piece_location[i].row][current_piece_location[i].col].piece_id = tpiece.PIECE_ID_EMPTY
-                self.grid[current_piece_location[i].row][current_piece_location[i].col].shape_id = tpiece.SHAPE_ID_EMPTY
-            for i in range(len(rotated_piece)):
-                self.grid[rotated_piece[i][1]][rotated_piece[i][0]].empty = False
-                self.grid[rotated_piece[i][1]][rotated_piece[i][0]].piece_id = self.current_piece_id
-                self.grid[rotated_piece[i][1]][rotated_piece[i][0]].shape_id = self.current_shape_id
-        
-    def rotate_single_square_around_rotation_point(self, square_location, rotation_point, angle_of_rotation=pi/2):
-        rot_mat = [[cos(angle_of_rotation), -sin(angle_of_rotation)],
-                   [sin(angle_of_rotation), cos(angle_of_rotation)]]
-        original_point = [[float(square_location.col - rotation_point[1])], 
-                          [float(square_location.row - rotation_point[0])]]
-
-        result = [0, 0]
-        if rotation_point[0] % 1 > 0.3 or rotation_point[1] % 1 > 0.3:
-            for i in range(2):
-                result[i] = round(rot_mat[i][0] * original_point[0][0] + rot_mat[i][1] * original_point[1][0], 3)
-        else:
-            for i in range(2):
-                result[i] = round(rot_mat[i][0] * original_point[0][0] + rot_mat[i][1] * original_point[1][0])
+    def get_rotated_state(self, shape_id, rotation, origin_row, origin_col, quarter_turns):
+        # Looks up the target rotation state and tries the kick offsets of
+        # the shape in order. Returns (rotation, origin_row, origin_col) of
+        # the first one that fits, or None.
+        rotation = (rotation + quarter_turns) % 4
+        offsets = rtable.STATES_ALL[shape_id][rotation]
+        for d_row, d_col in rtable.KICK_OFFSETS_ALL[shape_id]:
+            if self.board.fits(offsets, origin_row + d_row, origin_col + d_col):
+                return (rotation, origin_row + d_row, origin_col + d_col)
+        return None
+
+    def rotate_piece(self, quarter_turns):
+        # Returns True if the piece was rotated.
+        piece = self.current_piece
+        rotated_state = self.get_rotated_state(piece.shape_id, piece.rotation, piece.origin_row, piece.origin_col, quarter_turns)
+        if rotated_state is None:
+            return False
+        piece.rotation, piece.origin_row, piece.origin_col = rotated_state
+        piece.offsets = rtable.STATES_ALL[piece.shape_id][piece.rotation]
+        return True
 
-        result[0] = int(result[0] + rotation_point[1])
-        result[1] = int(result[1] + rotation_point[0])
-        return result
+    def rotate_piece_clock_wise(self):
+        return self.rotate_piece(1)
+
+    def rotate_piece_counter_clock_wise(self):
+        return self.rotate_piece(3)
+
+    def rotate_piece_180(self):
+        return self.rotate_piece(2)
+
+    def enumerate_placements(self):
+        # Searches every (rotation, row, col) the current piece can reach
+        # with the ACTION_* inputs, including soft drop tucks and spins, and
+        # returns one Placement per distinct footprint it can lock into.
+        # Kicks only move sideways, so the search goes one row at a time.
+        piece = self.current_piece
+        if not piece.offsets:
+            return []
+        shape_id = piece.shape_id
+        states = rtable.STATES_ALL[shape_id]
+        fits = self.board.fits
+        moves = ((self.ACTION_LEFT, -1), (self.ACTION_RIGHT, 1))
+        turns = ((self.ACTION_ROTATE_CW, 1), (self.ACTION_ROTATE_CCW, 3), (self.ACTION_ROTATE_180, 2))
+
+        # Rows where no rotation of the piece can touch the stack. Nothing
+        # new can happen while falling through them.
+        max_d_row = max(d_row for offsets in states for d_row, d_col in offsets)
+        last_free_row = self.num_of_rows - self.max_height_of_stacked_pieces - max_d_row - 1
+
+        start = (piece.rotation, piece.origin_row, piece.origin_col)
+        paths = {start: ()}
+        placements = {}
+        row_states = [start]
+        while row_states:
+            row = row_states[0][1]
+            if row < last_free_row and row > piece.origin_row:
+                skip = last_free_row - row
+                for state in row_states:
+                    paths[(state[0], state[1] + skip, state[2])] = paths[state] + (self.ACTION_DOWN,) * skip
+                row_states = [(state[0], state[1] + skip, state[2]) for state in row_states]
+            queue = deque(row_states)
+            row_states = []
+            while queue:
+                state = queue.popleft()
+                row_states.append(state)
+                rotation, row, col = state
+                next_states = []
+                for action, d_col in moves:
+                    if fits(states[rotation], row, col + d_col):
+                        next_states.append((action, (rotation, row, col + d_col)))
+                for action, quarter_turns in turns:
+                    next_state = self.get_rotated_state(shape_id, rotation, row, col, quarter_turns)
+                    if next_state is not None:
+                        next_states.append((action, next_state))
+                for action, next_state in next_states:
+                    if next_state not in paths:
+                        paths[next_state] = paths[state] + (action,)
+                        queue.append(next_state)
+
+            below_states = []
+            for state in row_states:
+                rotation, row, col = state
+                if fits(states[rotation], row + 1, col):
+                    below_states.append((rotation, row + 1, col))
+                    paths.setdefault(below_states[-1], paths[state] + (self.ACTION_DOWN,))
+                    continue
+                # Resting: a hard drop from where the soft drops started
+                # lands here.
+                path = paths[state]
+                while path and path[-1] == self.ACTION_DOWN:
+                    path = path[:-1]
+                path += (self.ACTION_HARD_DROP,)
+                cells = tuple(sorted((row + d_row, col + d_col) for d_row, d_col in states[rotation]))
+                if cells not in placements or len(path) < len(placements[cells].path):
+                    placements[cells] = Placement(rotation, row, col, cells, path)
+            row_states = list(dict.fromkeys(below_states))
+        return list(placements.values())
+
+    def apply_placement(self, placement):
+        # Moves the current piece straight to the placement and locks it.
+        piece = self.current_piece
+        piece.rotation = placement.rotation
+        piece.origin_row = placement.origin_row
+        piece.origin_col = placement.origin_col
+        piece.offsets = rtable.STATES_ALL[piece.shape_id][piece.rotation]
+        return self.current_piece_has_reached_bottom()
+
+    def get_drop_distance(self):
+        # Number of rows the current piece can fall. While the piece is above
+        # the stack in every column it covers, the answer follows from the
+        # lowest square per column and the column heights. A piece tucked
+        # under an overhang falls back to moving down one row at a time.
+        piece = self.current_piece
+        lowest_rows = {}
+        for row, col in piece.cells():
+            if lowest_rows.get(col, -1) < row:
+                lowest_rows[col] = row
+        drop_distance = self.num_of_rows
+        for col, row in lowest_rows.items():
+            top = self.num_of_rows - self.column_heights[col]
+            if row >= top:
+                drop_distance = 0
+                while self.board.fits(piece.offsets, piece.origin_row + drop_distance + 1, piece.origin_col):
+                    drop_distance += 1
+                return drop_distance
+            drop_distance = min(drop_distance, top - row - 1)
+        return drop_distance if lowest_rows else 0
 
     def drop_current_piece_to_bottom(self):
-        while self.can_current_piece_move_one_down():
-            self.move_current_piece_one_down()
-        self.current_piece_has_reached_bottom()
+        self.current_piece.origin_row += self.get_drop_distance()
+        return self.current_piece_has_reached_bottom()
 
     def current_piece_has_reached_bottom(self):
-        self.remove_full_rows()
-        self.count_num_of_holes()
-        self.meassure_max_height()
+        cells = self.current_piece.cells()
+        self.board.lock_cells(cells, self.current_shape_id)
+        self.board_hash ^= self.zobrist.hash_cells(cells)
+        self.current_piece = ActivePiece()
+        self.num_of_pieces_placed += 1
+        self.update_column_stats(cells)
+        cleared_rows = self.remove_full_rows(cells)
+        if cleared_rows:
+            self.rebase_column_stats(cleared_rows)
+        self.last_cleared_rows = cleared_rows
         if self.running_game:
             self.select_new_current_piece()
         if self.can_new_piece_be_placed():
             self.place_new_current_piece()
         else:
-            print('Can\'t place new piece.. ')
+            if self.verbose:
+                print('Can\'t place new piece.. ')
             self.running_game = False 
+        return cleared_rows
+
+    def remove_full_rows(self, cells):
+        # Only the rows the locked piece covers can have become full. The top
+        # row is never cleared. Returns the removed rows in ascending order.
+        cleared_rows = sorted(set(row for row, col in cells if row > 0 and self.board.is_row_full(row)))
+        if cleared_rows:
+            # Only the rows down to the lowest cleared one change.
+            last_row = cleared_rows[-1]
+            self.board_hash ^= self.zobrist.hash_rows(self.board.masks, 0, last_row)
+            self.board.remove_rows(cleared_rows)
+            self.board_hash ^= self.zobrist.hash_rows(self.board.masks, 0, last_row)
+            self.num_of_rows_cleared += len(cleared_rows)
+        return cleared_rows
+
+    def update_column_stats(self, cells):
+        # Adds the squares of a locked piece to the stats of the columns it
+        # covers. Squares above the old top leave the gap below them as holes,
+        # squares below it fill a hole.
+        rows_per_column = {}
+        for row, col in cells:
+            rows_per_column.setdefault(col, []).append(row)
+        for col, rows in rows_per_column.items():
+            old_top = self.num_of_rows - self.column_heights[col]
+            new_top = min(old_top, min(rows))
+            new_holes = old_top - new_top - len(rows)
+            self.column_heights[col] = self.num_of_rows - new_top
+            self.column_holes[col] += new_holes
+            self.num_of_holes += new_holes
+            if self.max_height_of_stacked_pieces < self.column_heights[col]:
+                self.max_height_of_stacked_pieces = self.column_heights[col]
+
+    def rebase_column_stats(self, cleared_rows):
+        # Every column has a square in the cleared rows. Columns reaching
+        # above them just get lower, the rest are measured again.
+        first_cleared_row = min(cleared_rows)
+        for col in range(self.num_of_columns):
+            if self.num_of_rows - self.column_heights[col] < first_cleared_row:
+                self.column_heights[col] -= len(cleared_rows)
+            else:
+                self.meassure_column(col)
+        self.num_of_holes = sum(self.column_holes)
+        self.max_height_of_stacked_pieces = max(self.column_heights)
 
-    def remove_full_rows(self):
-        row = self.num_of_rows - 1
-        while row > 0:
-            row_has_no_pieces = True
-            row_is_full = True
-            for col in range(self.num_of_columns):
-                if self.grid[row][col].empty:
-                    row_is_full = False
-                else:
-                    row_has_no_pieces = False
-            if row_has_no_pieces:
-                return
-            if row_is_full:
-                for r in range(row, 0, -1):
-                    for c in range(self.num_of_columns):
-                        self.grid[r][c].empty      = self.grid[r - 1][c].empty
-                        self.grid[r][c].piece_id   = self.grid[r - 1][c].piece_id
-                        self.grid[r][c].shape_id   = self.grid[r - 1][c].shape_id
-                row += 1
-                self.num_of_rows_cleared += 1
-            row -= 1
+    def meassure_column(self, col):
+        self.column_heights[col] = 0
+        self.column_holes[col] = 0
+        for row in range(self.num_of_rows):
+            if self.board.is_occupied(row, col):
+                if not self.column_heights[col]:
+                    self.column_heights[col] = self.num_of_rows - row
+            elif self.column_heights[col]:
+                self.column_holes[col] += 1
 
     def count_num_of_holes(self):
-        self.num_of_holes = 0
+        # Full recount from the board, also refreshes the column stats.
         for col in range(self.num_of_columns):
-            is_block_in_column = False
-            for row in range(0, self.num_of_rows):
-                if not self.grid[row][col].empty: # and not self.grid[row][col].piece_id == self.current_piece_id:
-                    is_block_in_column = True
-                if is_block_in_column and self.grid[row][col].empty:
-                    self.num_of_holes += 1
+            self.meassure_column(col)
+        self.num_of_holes = sum(self.column_holes)
 
     def meassure_max_height(self):
         self.max_height_of_stacked_pieces = 0
-        height = 0
-        for col in range(self.num_of_columns):
-            for row in range(self.num_of_rows - 1, -1, -1):
-                if not self.grid[row][col].empty: # and not self.grid[row][col].piece_id == self.current_piece_id:
-                    height = row * (-1) + self.num_of_rows
-            if self.max_height_of_stacked_pieces < height:
-                self.max_height_of_stacked_pieces = height
+        for row in range(self.num_of_rows):
+            if self.board.masks[row]:
+                self.max_height_of_stacked_pieces = self.num_of_rows - row
+                return
 
-    def update_timers(self):
-        # Timer for dropping the current piece one down
-        self.timer_piece_fall_end = time()
-        if self.timer_piece_fall_end - self.timer_piece_fall_start > float(1 / self.fall_freq):
-            self.timer_piece_fall_start = time()
+    def apply_gravity(self):
+        if self.can_current_piece_move_one_down():
+            self.move_current_piece_one_down()
+        else:
+            self.current_piece_has_reached_bottom()
+
+    def apply_action(self, action):
+        if action == self.ACTION_LEFT:
+            self.move_current_piece_one_left()
+        elif action == self.ACTION_RIGHT:
+            self.move_current_piece_one_right()
+        elif action == self.ACTION_DOWN:
             if self.can_current_piece_move_one_down():
                 self.move_current_piece_one_down()
-            else:
-                self.current_piece_has_reached_bottom()
+        elif action == self.ACTION_ROTATE_CW:
+            self.rotate_piece_clock_wise()
+        elif action == self.ACTION_ROTATE_CCW:
+            self.rotate_piece_counter_clock_wise()
+        elif action == self.ACTION_ROTATE_180:
+            self.rotate_piece_180()
+        elif action == self.ACTION_HARD_DROP:
+            self.drop_current_piece_to_bottom()
+
+    def step(self, action=ACTION_NONE, ticks=1):
+        # Headless stepping: applies the action, then lets the given number
+        # of clock ticks pass. Needs a SimulationClock.
+        if self.recorder:
+            self.recorder.record(action, ticks)
+        if self.running_game and not action == self.ACTION_NONE:
+            self.apply_action(action)
+        if ticks:
+            self.clock.advance(ticks)
+            self.update_timers()
+        return self.running_game
+
+    def update_timers(self):
+        # Timer for dropping the current piece one down. Catches up on every
+        # fall interval that has passed since the last call.
+        self.timer_piece_fall_end = self.clock()
+        fall_interval = float(1 / self.fall_freq)
+        while self.running_game and self.timer_piece_fall_end - self.timer_piece_fall_start > fall_interval:
+            self.timer_piece_fall_start += fall_interval
+            self.apply_gravity()
         
         # Timer for increasing the fall speed of the durrent piece
-        self.timer_speed_update_end = time()
+        self.timer_speed_update_end = self.clock()
         if self.timer_speed_update_end - self.timer_speed_update_start > self.FALL_SPEED_UPDATE_SEC:
-            self.timer_speed_update_start = time()
+            self.timer_speed_update_start += self.FALL_SPEED_UPDATE_SEC
             self.fall_freq += self.FALL_SPEED_FREQ_INC
             # print('Speed updated.')
     
     def reset_all_timers(self):
-        self.timer_speed_update_start = time()
-        self.timer_speed_update_end = time()
-        self.timer_piece_fall_start = time()
-        self.timer_piece_fall_end = time()
+        self.timer_speed_update_start = self.clock()
+        self.timer_speed_update_end = self.clock()
+        self.timer_piece_fall_start = self.clock()
+        self.timer_piece_fall_end = self.clock()
 
     def run(self):
         while self.running_game:
-            self.update_timers()
+            if isinstance(self.clock, SimulationClock):
+                self.step()
+            else:
+                self.update_timers()
 
     def print_map(self):
         for row in range(self.num_of_rows):
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+'''
+    Asyncio server hosting many TetrisGame sessions in one process, one per
+    TCP connection. All games share one SimulationClock that the server
+    advances TICKS_PER_SEC times a second. A timer wheel holds every session
+    at the tick its next gravity fall or speed up is due, so a tick only
+    touches the sessions that have inputs or are due. Inputs are batched:
+    whatever arrived since the last tick is applied at the start of the
+    next one.
+
+    Protocol, little-endian:
+        client -> server    one byte per input, a TetrisGame.ACTION_* or
+                            CMD_NEW_GAME
+        server -> client    frames of FRAME_HEADER (payload size, tick) and
+                            a payload of STATE and, for every board row that
+                            changed since the last frame, the row number and
+                            the shape ids of its squares
+
+    Frames are diffs against the last frame sent to the client. While its
+    write buffer is full the session stays queued, one frame covers the
+    changes once it drains.
+
+        python game_server.py --sessions 500 --seconds 10
+'''
+
+import argparse
+import asyncio
+import json
+import random as rand
+import struct
+import tracemalloc
+from time import perf_counter, process_time
+
+from game import TetrisGame as tgame
+from sim_clock import SimulationClock
+from profiler import Profiler
+
+FRAME_HEADER = struct.Struct('<HI')
+# running, current shape id, next shape id, rotation, origin row, origin col,
+# pieces placed, rows cleared, number of changed rows
+STATE = struct.Struct('<?BBBbbIIB')
+CMD_NEW_GAME = 0xFE
+
+class GameSession(object):
+    '''
+        One game and what its client was last sent.
+    '''
+    def __init__(self, session_id, clock, seed=None, num_of_rows=20, num_of_columns=10, writer=None):
+        self.session_id = session_id
+        self.game = tgame(num_of_rows, num_of_columns, clock=clock, seed=seed, verbose=False)
+        self.writer = writer
+        self.closed = False
+        self.pending_inputs = bytearray()
+        # Tick the session is on the timer wheel for, None when off it.
+        self.due_tick = None
+
+        # 0xFF never is a shape id, the first frame sends every row.
+        self.sent_shape_ids = bytearray(b'\xff') * (num_of_rows * num_of_columns)
+        self.sent_state = None
+
+        self.cpu_time = 0.0
+        self.num_of_inputs = 0
+        self.num_of_frames = 0
+        self.num_of_bytes = 0
+
+    def get_frame(self, tick):
+        # Diff since the last frame, None if nothing changed.
+        game = self.game
+        piece = game.current_piece
+        shape_ids = game.board.shape_ids
+        changed_rows = []
+        if not shape_ids == self.sent_shape_ids:
+            num_of_columns = game.num_of_columns
+            for row in range(game.num_of_rows):
+                start = row * num_of_columns
+                if not shape_ids[start:start + num_of_columns] == self.sent_shape_ids[start:start + num_of_columns]:
+                    changed_rows.append(row)
+            self.sent_shape_ids[:] = shape_ids
+        state = (game.running_game, game.current_shape_id, game.next_shape_id, piece.rotation,
+                 piece.origin_row, piece.origin_col, game.num_of_pieces_placed, game.num_of_rows_cleared)
+        if state == self.sent_state and not changed_rows:
+            return None
+        self.sent_state = state
+
+        payload = bytearray(STATE.pack(*state, len(changed_rows)))
+        for row in changed_rows:
+            payload.append(row)
+            payload += shape_ids[row * game.num_of_columns:(row + 1) * game.num_of_columns]
+        return FRAME_HEADER.pack(len(payload), tick) + payload
+
+    def get_stats(self):
+        return {'session_id': self.session_id,
+                'cpu_ms': self.cpu_time * 1000,
+                'inputs': self.num_of_inputs,
+                'frames': self.num_of_frames,
+                'bytes_sent': self.num_of_bytes,
+                'pieces_placed': self.game.num_of_pieces_placed,
+                'rows_cleared': self.game.num_of_rows_cleared}
+
+class GameServer(object):
+    '''
+        Hosts GameSessions, see the module docstring. Sessions without a
+        writer are headless, for measuring the scheduler alone.
+    '''
+    HOST                    = '127.0.0.1'
+    PORT                    = 7777
+    TICKS_PER_SEC           = 60
+    # Slots of the timer wheel, more than the ticks of the longest fall
+    # interval keeps sessions from going around it.
+    WHEEL_SIZE              = 128
+    # Inputs applied per session and tick, the rest wait for the next ticks.
+    # Beyond MAX_PENDING_INPUTS new inputs are dropped.
+    MAX_INPUTS_PER_TICK     = 8
+    MAX_PENDING_INPUTS      = 64
+    WRITE_BUFFER_LIMIT      = 1 << 16
+    # Further behind than this the server drops ticks, game time slows down.
+    MAX_LAG_TICKS           = 15
+    READ_SIZE               = 4096
+    # Pending connections, sessions tend to connect in bursts.
+    BACKLOG                 = 1024
+
+    def __init__(self, host=HOST, port=PORT, ticks_per_sec=TICKS_PER_SEC, num_of_rows=20, num_of_columns=10,
+                 profiler=None):
+        self.host = host
+        self.port = port
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.clock = SimulationClock(ticks_per_sec)
+        self.profiler = Profiler() if profiler is None else profiler
+
+        self.sessions = {}
+        self.next_session_id = 1
+        self.wheel = [[] for i in range(self.WHEEL_SIZE)]
+        # Sessions with new inputs, in arrival order.
+        self.input_sessions = {}
+        # Sessions to send a frame to after this tick.
+        self.changed_sessions = {}
+
+        self.server = None
+        self.tick_task = None
+        # handle_client() tasks of the open connections.
+        self.client_tasks = set()
+        self.num_of_dropped_ticks = 0
+        self.num_of_session_ticks = 0
+        self.num_of_sessions_opened = 0
+        self.peak_sessions = 0
+        # Sums of the stats of the closed sessions.
+        self.closed_totals = {'cpu_time': 0.0, 'num_of_inputs': 0, 'num_of_frames': 0, 'num_of_bytes': 0}
+        self.tick_time = 0.0
+        self.start_cpu_time = process_time()
+        self.memory_per_session = None
+
+    def open_session(self, writer=None, seed=None):
+        session = GameSession(self.next_session_id, self.clock, seed, self.num_of_rows, self.num_of_columns, writer)
+        self.next_session_id += 1
+        self.sessions[session.session_id] = session
+        self.num_of_sessions_opened += 1
+        self.peak_sessions = max(self.peak_sessions, len(self.sessions))
+        self.new_game(session)
+        return session
+
+    def close_session(self, session):
+        if session.closed:
+            return
+        session.closed = True
+        for name in self.closed_totals:
+            self.closed_totals[name] += getattr(session, name)
+        self.sessions.pop(session.session_id, None)
+        self.input_sessions.pop(session, None)
+        self.changed_sessions.pop(session, None)
+
+    def new_game(self, session):
+        session.game.setup_new_game()
+        self.schedule(session)
+        self.changed_sessions[session] = None
+
+    def is_due(self, game, tick):
+        # Same comparisons as TetrisGame.update_timers().
+        now = tick / self.clock.ticks_per_sec
+        return now - game.timer_piece_fall_start > float(1 / game.fall_freq) \
+            or now - game.timer_speed_update_start > game.FALL_SPEED_UPDATE_SEC
+
+    def get_due_tick(self, game):
+        # First tick after the current one at which update_timers() has
+        # something to do.
+        due_time = min(game.timer_piece_fall_start + float(1 / game.fall_freq),
+                       game.timer_speed_update_start + game.FALL_SPEED_UPDATE_SEC)
+        tick = max(int(due_time * self.clock.ticks_per_sec), self.clock.ticks + 1)
+        while not self.is_due(game, tick):
+            tick += 1
+        return tick
+
+    def schedule(self, session):
+        if not session.game.running_game:
+            session.due_tick = None
+            return
+        due_tick = self.get_due_tick(session.game)
+        if not due_tick == session.due_tick:
+            session.due_tick = due_tick
+            self.wheel[due_tick % self.WHEEL_SIZE].append((due_tick, session))
+
+    def add_inputs(self, session, data):
+        room = self.MAX_PENDING_INPUTS - len(session.pending_inputs)
+        if room > 0:
+            session.pending_inputs += data[:room]
+            self.input_sessions[session] = None
+
+    def apply_inputs(self, session):
+        game = session.game
+        inputs = session.pending_inputs[:self.MAX_INPUTS_PER_TICK]
+        del session.pending_inputs[:self.MAX_INPUTS_PER_TICK]
+        session.num_of_inputs += len(inputs)
+        for action in inputs:
+            if action == CMD_NEW_GAME:
+                self.new_game(session)
+            elif game.running_game and action < tgame.NUM_OF_ACTIONS:
+                game.apply_action(action)
+        if not game.running_game:
+            session.due_tick = None
+        return bool(session.pending_inputs)
+
+    def tick(self):
+        # One tick: inputs, then gravity of the due sessions, then frames.
+        tick_start = perf_counter()
+        self.clock.advance()
+        tick = self.clock.ticks
+        changed_sessions = self.changed_sessions
+
+        input_sessions = self.input_sessions
+        self.input_sessions = {}
+        for session in input_sessions:
+            start = perf_counter()
+            if self.apply_inputs(session):
+                self.input_sessions[session] = None
+            changed_sessions[session] = None
+            session.cpu_time += perf_counter() - start
+
+        slot_index = tick % self.WHEEL_SIZE
+        slot = self.wheel[slot_index]
+        self.wheel[slot_index] = []
+        for due_tick, session in slot:
+            if not due_tick == session.due_tick or session.closed:
+                continue
+            if due_tick > tick:
+                # Goes around the wheel again.
+                self.wheel[slot_index].append((due_tick, session))
+                continue
+            start = perf_counter()
+            session.game.update_timers()
+            self.schedule(session)
+            changed_sessions[session] = None
+            session.cpu_time += perf_counter() - start
+
+        self.changed_sessions = {}
+        for session in changed_sessions:
+            start = perf_counter()
+            self.send_frame(session, tick)
+            session.cpu_time += perf_counter() - start
+
+        self.num_of_session_ticks += len(self.sessions)
+        tick_time = perf_counter() - tick_start
+        self.tick_time += tick_time
+        self.profiler.record('tick', tick_time)
+
+    def send_frame(self, session, tick):
+        writer = session.writer
+        if writer is None:
+            return
+        if writer.transport.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > self.WRITE_BUFFER_LIMIT:
+            # Tried again next tick, until a frame is written.
+            self.changed_sessions[session] = None
+            return
+        frame = session.get_frame(tick)
+        if frame:
+            writer.write(frame)
+            session.num_of_frames += 1
+            session.num_of_bytes += len(frame)
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.client_tasks.add(task)
+        session = self.open_session(writer)
+        try:
+            while True:
+                data = await reader.read(self.READ_SIZE)
+                if not data:
+                    break
+                self.add_inputs(session, data)
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by stop(), which waits for it. Ending normally keeps
+            # the asyncio stream callback from logging the cancellation.
+            pass
+        finally:
+            self.close_session(session)
+            writer.close()
+            self.client_tasks.discard(task)
+
+    async def run_ticks(self):
+        loop = asyncio.get_running_loop()
+        tick_interval = 1 / self.clock.ticks_per_sec
+        next_tick_time = loop.time()
+        while True:
+            self.tick()
+            next_tick_time += tick_interval
+            lag = loop.time() - next_tick_time
+            if lag > self.MAX_LAG_TICKS * tick_interval:
+                dropped = int(lag / tick_interval)
+                self.num_of_dropped_ticks += dropped
+                next_tick_time += dropped * tick_interval
+            await asyncio.sleep(max(0, next_tick_time - loop.time()))
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.BACKLOG)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.start_cpu_time = process_time()
+        self.tick_task = asyncio.create_task(self.run_ticks())
+
+    async def stop(self):
+        if self.tick_task:
+            self.tick_task.cancel()
+            try:
+                await self.tick_task
+            except asyncio.CancelledError:
+                pass
+            self.tick_task = None
+        if self.server:
+            self.server.close()
+            # The handlers close their sessions and writers when cancelled.
+            tasks = list(self.client_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for session in list(self.sessions.values()):
+                if session.writer:
+                    session.writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def measure_session_memory(self, count=100):
+        # Bytes allocated per headless session, game state only. Socket
+        # buffers come on top.
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = []
+        for i in range(count):
+            session = GameSession(0, self.clock, None, self.num_of_rows, self.num_of_columns)
+            session.game.setup_new_game()
+            sessions.append(session)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        if not was_tracing:
+            tracemalloc.stop()
+        self.memory_per_session = allocated / count
+        return self.memory_per_session
+
+    def get_stats(self):
+        # Costs per second of hosted session, over every session so far.
+        # The tick figures cover the game work, the process figures also the
+        # connections, and the bots when load testing in the same process.
+        # sessions_per_core is the inverse of the tick CPU per session.
+        totals = dict(self.closed_totals)
+        for session in self.sessions.values():
+            for name in totals:
+                totals[name] += getattr(session, name)
+        session_sec = self.num_of_session_ticks / self.clock.ticks_per_sec
+        process_cpu_time = process_time() - self.start_cpu_time
+        tick_summary = [phase for phase in self.profiler.get_summary() if phase['phase'] == 'tick']
+        def per_session_sec(value):
+            return value / session_sec if session_sec else 0.0
+        return {'sessions': len(self.sessions),
+                'peak_sessions': self.peak_sessions,
+                'sessions_opened': self.num_of_sessions_opened,
+                'ticks': self.clock.ticks,
+                'dropped_ticks': self.num_of_dropped_ticks,
+                'tick': tick_summary[0] if tick_summary else None,
+                'session_sec': session_sec,
+                'tick_cpu_sec': self.tick_time,
+                'process_cpu_sec': process_cpu_time,
+                'tick_cpu_per_session_sec': per_session_sec(self.tick_time),
+                'process_cpu_per_session_sec': per_session_sec(process_cpu_time),
+                'sessions_per_core': session_sec / self.tick_time if self.tick_time else None,
+                'memory_per_session_bytes': self.memory_per_session,
+                'inputs_per_session_sec': per_session_sec(totals['num_of_inputs']),
+                'frames_per_session_sec': per_session_sec(totals['num_of_frames']),
+                'bytes_per_session_sec': per_session_sec(totals['num_of_bytes'])}
+
+    def get_session_stats(self, session_id):
+        return self.sessions[session_id].get_stats()
+
+class GameClient(object):
+    '''
+        Keeps a copy of its session by applying the server frames.
+    '''
+    def __init__(self, num_of_rows=20, num_of_columns=10):
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.shape_ids = bytearray(b'\xff') * (num_of_rows * num_of_columns)
+        self.state = None
+        self.tick = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host=GameServer.HOST, port=GameServer.PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    def send(self, inputs):
+        self.writer.write(bytes(inputs))
+
+    async def receive(self):
+        # Waits for the next frame and applies it, returns its tick.
+        size, self.tick = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+        self.apply_frame(await self.reader.readexactly(size))
+        return self.tick
+
+    def apply_frame(self, payload):
+        state = STATE.unpack_from(payload)
+        self.state = state[:-1]
+        pos = STATE.size
+        num_of_columns = self.num_of_columns
+        for i in range(state[-1]):
+            row = payload[pos]
+            self.shape_ids[row * num_of_columns:(row + 1) * num_of_columns] = payload[pos + 1:pos + 1 + num_of_columns]
+            pos += 1 + num_of_columns
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def receive_frames(client):
+    while True:
+        await client.receive()
+
+async def run_bot(client, host, port, seconds, seed):
+    # Random inputs every 5 to 30 ticks, new game after game over. Inputs
+    # go out on a timer, a move that changes nothing gets no frame back.
+    rng = rand.Random(seed)
+    await client.connect(host, port)
+    receiver = asyncio.create_task(receive_frames(client))
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + seconds
+    try:
+        while loop.time() < end_time and not receiver.done():
+            await asyncio.sleep(rng.randrange(5, 30) / GameServer.TICKS_PER_SEC)
+            if client.state and not client.state[0]:
+                client.send([CMD_NEW_GAME])
+            else:
+                client.send([rng.randrange(tgame.NUM_OF_ACTIONS)])
+    finally:
+        receiver.cancel()
+        try:
+            await receiver
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        await client.close()
+
+async def load_test(args):
+    server = GameServer(port=args.port)
+    server.measure_session_memory()
+    await server.start()
+    if args.headless:
+        for i in range(args.sessions):
+            server.open_session()
+        await asyncio.sleep(args.seconds)
+    else:
+        bots = [run_bot(GameClient(), server.host, server.port, args.seconds, seed) for seed in range(args.sessions)]
+        await asyncio.gather(*bots)
+    stats = server.get_stats()
+    await server.stop()
+    return stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Host Tetris game sessions, or load test the server.')
+    parser.add_argument('--port', type=int, default=GameServer.PORT, help='0 picks a free port')
+    parser.add_argument('--serve', action='store_true', help='serve until interrupted instead of load testing')
+    parser.add_argument('--sessions', type=int, default=200, help='bot clients of the load test')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the load test')
+    parser.add_argument('--headless', action='store_true', help='load test without connections')
+    return parser.parse_args(argv)
+
+async def serve(args):
+    server = GameServer(port=args.port)
+    await server.start()
+    print(f'Serving on {server.host}:{server.port}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.serve:
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(json.dumps(asyncio.run(load_test(args)), indent=4))
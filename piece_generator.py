@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import hashlib
+import random as rand
+from itertools import permutations
+from transposition_cache import TranspositionCache
+
+# Pre-generated batches, shared by every generator of the same kind and seed
+# in this process.
+batch_cache = TranspositionCache(max_size=256)
+
+# Top 3 bits of a byte, and the bytes whose top 3 bits are 7.
+TOP_3_BITS = bytes(byte >> 5 for byte in range(256))
+TOP_3_BITS_7 = bytes(range(7 << 5, 256))
+# Every order of the seven shapes, for BagGenerator.
+BAG_ORDERS = [bytes(order) for order in permutations(range(7))]
+# Seeds are kept below 1 << SEED_BITS, so they fit the signed 64 bit field
+# of game snapshots.
+SEED_BITS = 63
+
+def normalize_seed(seed):
+    # Ints in [0, 1 << SEED_BITS) are kept, other ints are taken modulo that
+    # and str or bytes seeds are hashed into it. hash() is not used, it
+    # differs between processes.
+    if isinstance(seed, int):
+        return seed % (1 << SEED_BITS)
+    if isinstance(seed, str):
+        seed = seed.encode('utf-8')
+    if not isinstance(seed, (bytes, bytearray)):
+        raise TypeError(f"seed ({type(seed).__name__}) must be an int, str or bytes")
+    digest = hashlib.blake2b(bytes(seed), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> (64 - SEED_BITS)
+
+class PieceGenerator(object):
+    '''
+        Seeded stream of shape ids, pre-generated in batches of BATCH_SIZE
+        into immutable bytes. Every batch is generated from its own RNG,
+        seeded from the generator seed and the batch index, so the state of
+        a generator is only (seed, batch index, position). Copies and
+        generators with the same seed share the batches.
+    '''
+    NUM_OF_SHAPES   = 7
+    BATCH_SIZE      = 4096
+
+    def __init__(self, seed=None):
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        # Starts the stream over, on a new random seed if none is given. The
+        # batch is generated on the first draw, so a reset straight after
+        # costs nothing.
+        self.seed = rand.getrandbits(SEED_BITS) if seed is None else normalize_seed(seed)
+        self.batch_index = 0
+        self.batch = None
+        self.pos = 0
+
+    def get_batch_key(self):
+        return (type(self).__name__, self.seed)
+
+    def get_batch(self, batch_index):
+        return batch_cache.get_or_compute(self.get_batch_key() + (batch_index,),
+                                          lambda: self.generate_batch(batch_index))
+
+    def get_batch_rng(self, batch_index):
+        # The first batch draws from Random(seed) directly.
+        return rand.Random(self.seed if batch_index == 0 else f'{self.seed}/{batch_index}')
+
+    def generate_batch(self, batch_index):
+        raise NotImplementedError
+
+    def next(self):
+        if self.batch is None:
+            self.batch = self.get_batch(self.batch_index)
+        if self.pos >= len(self.batch):
+            self.batch_index += 1
+            self.batch = self.get_batch(self.batch_index)
+            self.pos = 0
+        shape_id = self.batch[self.pos]
+        self.pos += 1
+        return shape_id
+
+    def peek(self, count):
+        # The next count shape ids, without taking them.
+        if self.batch is None:
+            self.batch = self.get_batch(self.batch_index)
+        preview = list(self.batch[self.pos:self.pos + count])
+        batch_index = self.batch_index
+        while len(preview) < count:
+            batch_index += 1
+            preview += self.get_batch(batch_index)[:count - len(preview)]
+        return preview
+
+    def get_state(self):
+        return (self.seed, self.batch_index, self.pos)
+
+    def set_state(self, state):
+        seed, batch_index, pos = state
+        if not (seed, batch_index) == (self.seed, self.batch_index):
+            self.seed = seed
+            self.batch_index = batch_index
+            self.batch = None
+        self.pos = pos
+
+    def copy(self):
+        # The batches are immutable and shared.
+        generator = object.__new__(type(self))
+        generator.__dict__.update(self.__dict__)
+        return generator
+
+class UniformGenerator(PieceGenerator):
+    '''
+        Every shape with the same probability, independent of the others.
+        Draws the same shapes as random.Random(seed).randint(0, 6) did.
+    '''
+    def generate_batch(self, batch_index):
+        # Same shapes as one randrange(7) per piece, without a Python call
+        # per piece: CPython draws every 3 bit number from the top bits of a
+        # 32 bit output and skips the 7s, and one getrandbits() of many
+        # words returns the same outputs, the first in the lowest bits.
+        rng = self.get_batch_rng(batch_index)
+        batch = b''
+        while len(batch) < self.BATCH_SIZE:
+            num_of_words = (self.BATCH_SIZE - len(batch)) * 8 // 7 + 16
+            words = rng.getrandbits(32 * num_of_words).to_bytes(4 * num_of_words, 'little')
+            batch += words[3::4].translate(TOP_3_BITS, TOP_3_BITS_7)
+        return batch[:self.BATCH_SIZE]
+
+class BagGenerator(PieceGenerator):
+    '''
+        7-bag: every run of seven pieces holds every shape once, in random
+        order.
+    '''
+    BATCH_SIZE      = 7 * 512
+
+    def generate_batch(self, batch_index):
+        # One draw per bag instead of shuffling it.
+        randrange = self.get_batch_rng(batch_index).randrange
+        return b''.join(BAG_ORDERS[randrange(len(BAG_ORDERS))] for i in range(self.BATCH_SIZE // self.NUM_OF_SHAPES))
+
+class SequenceGenerator(PieceGenerator):
+    '''
+        Repeats a fixed sequence of shape ids, e.g. one pre-generated by
+        another generator to play several games on the same pieces. The seed
+        is not used.
+    '''
+    def __init__(self, sequence, seed=0):
+        if not sequence:
+            raise ValueError("sequence must not be empty")
+        self.sequence = bytes(sequence)
+        super().__init__(seed)
+
+    def get_batch(self, batch_index):
+        return self.sequence
+
+GENERATORS = {
+    'uniform': UniformGenerator,
+    'bag': BagGenerator,
+}
@@ -14,6 +14,7 @@ class TetrisPiece(object):
     SHAPE_ID_EMPTY      = 7
 
     PIECE_ID_EMPTY      = 0
+    PIECE_ID_LOCKED     = -1
 
     # List of [y, x] = [row, col]
     SPAWN_LOCATION_EMPTY= [[0, 0], [0, 0], [0, 0], [0, 0]]
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class Placement:
+    rotation: int
+    origin_row: int
+    origin_col: int
+    # Sorted ((row, col), ...) of the squares the piece locks into.
+    cells: tuple
+    # TetrisGame.ACTION_* inputs leading from the current piece position to
+    # this placement, ending with the hard drop that locks it. Apply them
+    # with step(action, 0) so gravity does not interfere.
+    path: tuple
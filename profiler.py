@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import math
+from collections import deque
+from time import perf_counter
+
+class Profiler(object):
+    '''
+        Collects the wall time of named phases, e.g. the methods of a game or
+        UI handed to instrument(). The last WINDOW samples of every phase are
+        kept for rolling percentiles, the count and total cover the whole run.
+    '''
+    WINDOW              = 1000
+    PERCENTILES         = (50, 95, 99)
+    SUMMARY_FIELDS      = ['phase', 'count', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms']
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.totals = {}
+
+    def record(self, phase, seconds):
+        if phase not in self.samples:
+            self.samples[phase] = deque(maxlen=self.window)
+            self.counts[phase] = 0
+            self.totals[phase] = 0.0
+        self.samples[phase].append(seconds)
+        self.counts[phase] += 1
+        self.totals[phase] += seconds
+
+    def wrap(self, phase, function):
+        record = self.record
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(phase, perf_counter() - start)
+        return timed
+
+    def instrument(self, obj, method_names):
+        # Replaces the methods on this instance only, so nothing is timed, and
+        # nothing slowed down, unless a profiler is handed in.
+        for name in method_names:
+            setattr(obj, name, self.wrap(name, getattr(obj, name)))
+
+    def get_percentiles(self, phase):
+        # Nearest rank percentiles of the rolling window, in seconds.
+        samples = sorted(self.samples[phase])
+        return [samples[max(0, math.ceil(percentile / 100 * len(samples)) - 1)] for percentile in self.PERCENTILES]
+
+    def get_summary(self):
+        summary = []
+        for phase in self.samples:
+            p50, p95, p99 = self.get_percentiles(phase)
+            summary.append({'phase': phase,
+                            'count': self.counts[phase],
+                            'total_ms': self.totals[phase] * 1000,
+                            'mean_ms': self.totals[phase] / self.counts[phase] * 1000,
+                            'p50_ms': p50 * 1000,
+                            'p95_ms': p95 * 1000,
+                            'p99_ms': p99 * 1000})
+        return summary
+
+    def dump_json(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.get_summary(), output, indent=4)
+
+    def dump_csv(self, path):
+        with open(path, 'w', newline='') as output:
+            writer = csv.DictWriter(output, fieldnames=self.SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.get_summary())
+
+    def dump(self, path):
+        if path.endswith('.json'):
+            self.dump_json(path)
+        else:
+            self.dump_csv(path)
+
+    def clear(self):
+        self.samples.clear()
+        self.counts.clear()
+        self.totals.clear()
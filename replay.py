@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+'''
+    Compact binary replays of headless games. A game is stored as its seed
+    and the (action, ticks) of every TetrisGame.step() call, plus a digest of
+    the final board, rows cleared and holes. Replaying re-simulates the game
+    on a SimulationClock as fast as the CPU allows and compares the digest.
+
+    Layout, all integers are unsigned LEB128 varints:
+        magic b'TRPL', version byte
+        rows, columns, ticks per second, start tick, seed
+        length and ASCII name of the piece generator, length and shape ids
+        of its sequence (SequenceGenerator only, else empty)
+        number of records, then per record: action byte, ticks, repeat count
+        number of digest bytes, digest
+
+    Version 1 replays have no generator, they were played on the uniform
+    one.
+'''
+
+import argparse
+import hashlib
+import os
+import sys
+import random as rand
+from concurrent.futures import ProcessPoolExecutor
+
+from game import TetrisGame as tgame
+from pieces import TetrisPiece as tpiece
+from sim_clock import SimulationClock
+from piece_generator import GENERATORS, SequenceGenerator
+
+MAGIC = b'TRPL'
+VERSION = 2
+# Piece generators a replay can be played with, by name.
+REPLAY_GENERATORS = dict(GENERATORS, sequence=SequenceGenerator)
+DIGEST_SIZE = 16
+# Limits of a record and of a whole replay, so a crafted replay cannot keep
+# the verifier busy. A minute of ticks per step, and more steps than hours
+# of play one step per tick.
+MAX_TICKS = 60 * 60
+MAX_STEPS = 1 << 22
+# Limits of the header. The board must hold the spawn location of every
+# shape, and the start tick stays exact as float seconds.
+MIN_ROWS = 1 + max(row for location in tpiece.SPAWN_LOCATION_ALL for row, col in location)
+MIN_COLUMNS = 1 + max(col for location in tpiece.SPAWN_LOCATION_ALL for row, col in location)
+MAX_ROWS = 256
+MAX_COLUMNS = 256
+MAX_TICKS_PER_SEC = 10000
+MAX_START_TICK = 1 << 48
+
+def encode_varint(value, output):
+    if value < 0:
+        raise ValueError(f"varint ({value}) must be >= 0")
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def decode_varint(data, pos):
+    # Returns (value, position after the varint).
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("replay is truncated")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def get_generator_name(generator):
+    for name, generator_type in REPLAY_GENERATORS.items():
+        if type(generator) is generator_type:
+            return name
+    raise ValueError(f"piece generator ({type(generator).__name__}) can not be replayed")
+
+def make_generator(name, seed, sequence=b''):
+    if name not in REPLAY_GENERATORS:
+        raise ValueError(f"unknown piece generator ({name})")
+    if REPLAY_GENERATORS[name] is SequenceGenerator:
+        return SequenceGenerator(sequence, seed)
+    return REPLAY_GENERATORS[name](seed)
+
+def compute_digest(game):
+    data = bytearray(game.board.shape_ids)
+    encode_varint(game.num_of_rows_cleared, data)
+    encode_varint(game.num_of_holes, data)
+    return hashlib.blake2b(bytes(data), digest_size=DIGEST_SIZE).digest()
+
+class Replay(object):
+    '''
+        Seed, piece generator and input log of one game. records is a list
+        of [action, ticks, count], i.e. count calls of step(action, ticks) in
+        a row.
+    '''
+    def __init__(self, seed, num_of_rows=20, num_of_columns=10, ticks_per_sec=SimulationClock.TICKS_PER_SEC,
+                 start_tick=0, records=None, digest=b'', generator='uniform', sequence=b''):
+        self.seed = seed
+        self.generator = generator
+        self.sequence = bytes(sequence)
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.ticks_per_sec = ticks_per_sec
+        self.start_tick = start_tick
+        self.records = [] if records is None else records
+        self.digest = digest
+
+    def add_step(self, action, ticks):
+        last = self.records[-1] if self.records else None
+        if last and last[0] == action and last[1] == ticks:
+            last[2] += 1
+        else:
+            self.records.append([action, ticks, 1])
+
+    def to_bytes(self):
+        data = bytearray(MAGIC)
+        data.append(VERSION)
+        for value in (self.num_of_rows, self.num_of_columns, self.ticks_per_sec, self.start_tick, self.seed):
+            encode_varint(value, data)
+        for value in (self.generator.encode('ascii'), self.sequence):
+            encode_varint(len(value), data)
+            data += value
+        encode_varint(len(self.records), data)
+        for action, ticks, count in self.records:
+            data.append(action)
+            encode_varint(ticks, data)
+            encode_varint(count, data)
+        encode_varint(len(self.digest), data)
+        data += self.digest
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data[:len(MAGIC)] == MAGIC:
+            raise ValueError("not a replay")
+        version = data[len(MAGIC)] if len(data) > len(MAGIC) else None
+        if version not in (1, VERSION):
+            raise ValueError(f"unsupported replay version ({version})")
+        pos = len(MAGIC) + 1
+        values = []
+        for i in range(5):
+            value, pos = decode_varint(data, pos)
+            values.append(value)
+        num_of_rows, num_of_columns, ticks_per_sec, start_tick, seed = values
+        if not MIN_ROWS <= num_of_rows <= MAX_ROWS:
+            raise ValueError(f"rows ({num_of_rows}) must be in [{MIN_ROWS}, {MAX_ROWS}]")
+        if not MIN_COLUMNS <= num_of_columns <= MAX_COLUMNS:
+            raise ValueError(f"columns ({num_of_columns}) must be in [{MIN_COLUMNS}, {MAX_COLUMNS}]")
+        if not 1 <= ticks_per_sec <= MAX_TICKS_PER_SEC:
+            raise ValueError(f"ticks per second ({ticks_per_sec}) must be in [1, {MAX_TICKS_PER_SEC}]")
+        if start_tick > MAX_START_TICK:
+            raise ValueError(f"start tick must be <= {MAX_START_TICK}")
+        generator = 'uniform'
+        sequence = b''
+        if version >= 2:
+            fields = []
+            for i in range(2):
+                size, pos = decode_varint(data, pos)
+                if pos + size > len(data):
+                    raise ValueError("replay is truncated")
+                fields.append(bytes(data[pos:pos + size]))
+                pos += size
+            generator = fields[0].decode('ascii', errors='replace')
+            sequence = fields[1]
+            if generator not in REPLAY_GENERATORS:
+                raise ValueError(f"unknown piece generator ({generator})")
+            if any(shape_id >= tgame.NUM_OF_SHAPES for shape_id in sequence):
+                raise ValueError("piece sequence holds invalid shape ids")
+        num_of_records, pos = decode_varint(data, pos)
+        records = []
+        num_of_steps = 0
+        for i in range(num_of_records):
+            if pos >= len(data):
+                raise ValueError("replay is truncated")
+            action = data[pos]
+            ticks, pos = decode_varint(data, pos + 1)
+            count, pos = decode_varint(data, pos)
+            if ticks > MAX_TICKS:
+                raise ValueError(f"record ticks ({ticks}) must be <= {MAX_TICKS}")
+            num_of_steps += count
+            if num_of_steps > MAX_STEPS:
+                raise ValueError(f"replay steps must be <= {MAX_STEPS}")
+            records.append([action, ticks, count])
+        digest_size, pos = decode_varint(data, pos)
+        digest = bytes(data[pos:pos + digest_size])
+        if not len(digest) == digest_size:
+            raise ValueError("replay is truncated")
+        return cls(seed, num_of_rows, num_of_columns, ticks_per_sec, start_tick, records, digest, generator,
+                   sequence)
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            output.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as replay_file:
+            return cls.from_bytes(replay_file.read())
+
+class ReplayRecorder(object):
+    '''
+        Records every step() of a game driven by a SimulationClock, up to
+        game over. Inputs applied by calling the game methods directly are
+        not recorded.
+    '''
+    def __init__(self, game):
+        self.game = game
+        self.replay = None
+
+    def start(self, seed=None):
+        # Starts a new game on a known seed and records it.
+        if seed is None:
+            seed = self.game.seed if self.game.seed is not None else rand.getrandbits(32)
+        generator = self.game.piece_generator
+        generator_name = get_generator_name(generator)
+        self.game.setup_new_game(seed)
+        # The generator keeps the seed normalized, e.g. a str seed hashed.
+        self.replay = Replay(generator.seed, self.game.num_of_rows, self.game.num_of_columns,
+                             self.game.clock.ticks_per_sec, self.game.clock.ticks, generator=generator_name,
+                             sequence=generator.sequence if generator_name == 'sequence' else b'')
+        self.game.recorder = self
+        return self.replay
+
+    def record(self, action, ticks):
+        # Steps after the game is over change nothing of the game and are
+        # rejected by play_replay().
+        if self.game.running_game:
+            self.replay.add_step(action, ticks)
+
+    def stop(self):
+        self.game.recorder = None
+        self.replay.digest = compute_digest(self.game)
+        return self.replay
+
+def play_replay(replay):
+    # Re-simulates the replay and returns the game in its final state. A
+    # replay with steps after the game is over is rejected, a recorded game
+    # stops there.
+    clock = SimulationClock(replay.ticks_per_sec)
+    clock.ticks = replay.start_tick
+    game = tgame(replay.num_of_rows, replay.num_of_columns, clock=clock, verbose=False,
+                 piece_generator=make_generator(replay.generator, replay.seed, replay.sequence))
+    game.setup_new_game(replay.seed)
+    step = game.step
+    for action, ticks, count in replay.records:
+        for i in range(count):
+            if not game.running_game:
+                raise ValueError("replay continues after game over")
+            step(action, ticks)
+    return game
+
+def verify_replay(replay):
+    return compute_digest(play_replay(replay)) == replay.digest
+
+def verify_file(path):
+    # Any error only fails this file, not the whole run.
+    try:
+        return path, verify_replay(Replay.load(path))
+    except Exception as error:
+        print(f'{path}: {type(error).__name__}: {error}', file=sys.stderr)
+        return path, False
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Verify Tetris replays by re-simulating them.')
+    parser.add_argument('replays', nargs='+', help='replay files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    num_of_failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for path, ok in executor.map(verify_file, args.replays, chunksize=16):
+            if not ok:
+                num_of_failed += 1
+                print(f'FAILED {path}')
+    print(f'{len(args.replays) - num_of_failed} of {len(args.replays)} replays verified', file=sys.stderr)
+    sys.exit(1 if num_of_failed else 0)
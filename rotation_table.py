@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+from pieces import TetrisPiece as tpiece
+
+def get_spawn_origin(shape_id):
+    center = tpiece.DEFAULT_ROTATION_CENTER_ALL[shape_id]
+    return (int(center[0]), int(center[1]))
+
+def build_rotation_states(shape_id):
+    # Works in doubled coordinates around the rotation center so the
+    # half-integer centers of I and O stay exact integers.
+    center = tpiece.DEFAULT_ROTATION_CENTER_ALL[shape_id]
+    center_row, center_col = int(2 * center[0]), int(2 * center[1])
+    origin_row, origin_col = get_spawn_origin(shape_id)
+    points = [(2 * row - center_row, 2 * col - center_col) for row, col in tpiece.SPAWN_LOCATION_ALL[shape_id]]
+
+    states = []
+    for rotation in range(4):
+        states.append(tuple(((center_row + p_row) // 2 - origin_row, (center_col + p_col) // 2 - origin_col)
+                            for p_row, p_col in points))
+        # Clockwise quarter turn, rows grow downwards.
+        points = [(p_col, -p_row) for p_row, p_col in points]
+    return tuple(states)
+
+def build_kick_offsets(rotation_states):
+    # Try the rotation in place first, then shift sideways as far as the
+    # piece reaches out from its origin.
+    max_shift = max(abs(d_col) for state in rotation_states for d_row, d_col in state)
+    kicks = [(0, 0)]
+    for shift in range(1, max_shift + 1):
+        kicks.append((0, shift))
+        kicks.append((0, -shift))
+    return tuple(kicks)
+
+
+class RotationTable(object):
+    '''
+        Square offsets (relative to the piece origin) of the 4 rotation states
+        of every shape, and the kick offsets tried when a rotation collides.
+        Rotation state 0 is the spawn orientation, each next state is one
+        clockwise quarter turn.
+    '''
+    STATES_ALL          = [build_rotation_states(shape_id) for shape_id in range(tpiece.SHAPE_ID_EMPTY)] + \
+                          [((), (), (), ())]
+    KICK_OFFSETS_ALL    = [build_kick_offsets(states) for states in STATES_ALL[:tpiece.SHAPE_ID_EMPTY]] + \
+                          [((0, 0),)]
+    SPAWN_ORIGIN_ALL    = [get_spawn_origin(shape_id) for shape_id in range(tpiece.SHAPE_ID_EMPTY + 1)]
+
+
+if __name__ == '__main__':
+    for shape_id, states in enumerate(RotationTable.STATES_ALL):
+        print(shape_id, states, RotationTable.KICK_OFFSETS_ALL[shape_id])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+'''
+    Plays many seeded headless games on a process pool and streams one JSON
+    line per finished game.
+
+    A policy is a factory taking the game seed and returning a callable that
+    maps a TetrisGame to one of the TetrisGame.ACTION_* constants. Use one of
+    the built-in names or 'module:factory' to load your own.
+'''
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import random as rand
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from game import TetrisGame as tgame
+from sim_clock import SimulationClock
+from ai_player import ai_policy
+from piece_generator import GENERATORS
+
+def random_policy(seed):
+    rng = rand.Random(seed)
+    def policy(game):
+        return rng.randrange(tgame.NUM_OF_ACTIONS)
+    return policy
+
+POLICIES = {
+    'random': random_policy,
+    'ai': ai_policy,
+}
+
+def load_policy(spec):
+    if spec in POLICIES:
+        return POLICIES[spec]
+    module_name, _, factory_name = spec.partition(':')
+    if not factory_name:
+        raise ValueError(f"policy ({spec}) must be one of {sorted(POLICIES)} or 'module:factory'")
+    return getattr(importlib.import_module(module_name), factory_name)
+
+def play_game(policy_spec, seed, max_pieces=0, ticks_per_step=1, num_of_rows=20, num_of_columns=10,
+              generator='uniform'):
+    game = tgame(num_of_rows, num_of_columns, clock=SimulationClock(), seed=seed, verbose=False,
+                 piece_generator=GENERATORS[generator](seed))
+    policy = load_policy(policy_spec)(seed)
+    start = perf_counter()
+    game.setup_new_game()
+    while game.running_game and (not max_pieces or game.num_of_pieces_placed < max_pieces):
+        game.step(policy(game), ticks_per_step)
+    return {'seed': seed,
+            'rows_cleared': game.num_of_rows_cleared,
+            'pieces_placed': game.num_of_pieces_placed,
+            'holes': game.num_of_holes,
+            'height': game.max_height_of_stacked_pieces,
+            'game_over': not game.running_game,
+            'wall_time': perf_counter() - start}
+
+def play_games(policy_spec, seeds, *args):
+    return [play_game(policy_spec, seed, *args) for seed in seeds]
+
+def run(args, output):
+    seeds = list(range(args.seed, args.seed + args.games))
+    chunks = [seeds[i:i + args.chunk_size] for i in range(0, len(seeds), args.chunk_size)]
+    game_args = (args.max_pieces, args.ticks_per_step, args.rows, args.columns, args.generator)
+    load_policy(args.policy)
+
+    start = perf_counter()
+    total_rows_cleared = 0
+    total_pieces = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(play_games, args.policy, chunk, *game_args) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                total_rows_cleared += result['rows_cleared']
+                total_pieces += result['pieces_placed']
+                output.write(json.dumps(result) + '\n')
+            output.flush()
+    wall_time = perf_counter() - start
+
+    print(f'{args.games} games in {wall_time:.2f} s, '
+          f'{total_pieces / wall_time:.0f} pieces/s, '
+          f'{total_rows_cleared / args.games:.2f} rows cleared per game', file=sys.stderr)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Play seeded headless Tetris games on a process pool.')
+    parser.add_argument('--games', type=int, default=100, help='number of games to play')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, the others count up')
+    parser.add_argument('--policy', default='random', help="built-in policy name or 'module:factory'")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=16, help='games sent to a worker at a time')
+    parser.add_argument('--max-pieces', type=int, default=0, help='stop a game after this many pieces, 0 for no limit')
+    parser.add_argument('--ticks-per-step', type=int, default=1, help='clock ticks passed after every action')
+    parser.add_argument('--rows', type=int, default=20)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--generator', choices=sorted(GENERATORS), default='uniform', help='piece generator')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.output:
+        with open(args.output, 'w') as output:
+            run(args, output)
+    else:
+        run(args, sys.stdout)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+'''
+    Streams training records from TetrisGame into preallocated memory-mapped
+    .npy shards, and reads them back without loading whole shards.
+
+    A directory holds shard_00000.npy, shard_00001.npy, ... of SHARD_SIZE
+    records each and index.json with the number of valid records per shard.
+    The last shard is only filled up to its count.
+'''
+
+import json
+import os
+import numpy as np
+
+from game import TetrisGame as tgame
+
+INDEX_FILE = 'index.json'
+SHARD_FILE = 'shard_{:05d}.npy'
+# Action of records of pieces locked outside of step(), e.g. by
+# apply_placement().
+NO_ACTION = 255
+
+def get_record_dtype(num_of_rows, num_of_columns):
+    # Board and piece are the state before the step or lock, the rest is
+    # the outcome.
+    return np.dtype([('board', np.uint8, (num_of_rows, num_of_columns)),
+                     ('current_shape_id', np.uint8),
+                     ('next_shape_id', np.uint8),
+                     ('rotation', np.uint8),
+                     ('origin_row', np.int8),
+                     ('origin_col', np.int8),
+                     ('action', np.uint8),
+                     ('reward', np.float32),
+                     ('holes', np.int16),
+                     ('height', np.int16),
+                     ('game_over', np.bool_)])
+
+class ShardRecorder(object):
+    '''
+        Records one entry per step() or per locked piece of the attached
+        games. The reward is the number of rows cleared. Every record is
+        written straight into the current shard, nothing is kept in lists.
+    '''
+    SHARD_SIZE      = 1 << 16
+    RECORD_STEPS    = 'step'
+    RECORD_LOCKS    = 'lock'
+
+    def __init__(self, directory, num_of_rows=20, num_of_columns=10, shard_size=SHARD_SIZE, record_on=RECORD_STEPS):
+        if record_on not in (self.RECORD_STEPS, self.RECORD_LOCKS):
+            raise ValueError(f"record_on ({record_on}) must be '{self.RECORD_STEPS}' or '{self.RECORD_LOCKS}'")
+        self.directory = directory
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.shard_size = shard_size
+        self.record_on = record_on
+        self.dtype = get_record_dtype(num_of_rows, num_of_columns)
+        os.makedirs(directory, exist_ok=True)
+
+        self.shard_counts = []
+        self.shard = None
+        self.columns = None
+        self.count = 0
+        self.open_shard()
+
+    def open_shard(self):
+        path = os.path.join(self.directory, SHARD_FILE.format(len(self.shard_counts)))
+        self.shard = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.shard_size,))
+        # One array per field, writing to them is much cheaper than to
+        # structured records.
+        self.columns = {name: self.shard[name] for name in self.dtype.names}
+        self.shard_counts.append(0)
+        self.count = 0
+
+    def close_shard(self):
+        self.shard.flush()
+        self.shard_counts[-1] = self.count
+        self.write_index()
+        self.shard = None
+        self.columns = None
+
+    def write_index(self):
+        index = {'num_of_rows': self.num_of_rows,
+                 'num_of_columns': self.num_of_columns,
+                 'shard_size': self.shard_size,
+                 'record_on': self.record_on,
+                 'shards': [{'file': SHARD_FILE.format(i), 'count': count} for i, count in enumerate(self.shard_counts)]}
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file, indent=4)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        if self.shard is not None:
+            self.close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def begin_record(self, game, board, action):
+        # Writes the state before the step or lock, returns the record slot.
+        if self.count == self.shard_size:
+            self.close_shard()
+            self.open_shard()
+        i = self.count
+        self.count += 1
+        columns = self.columns
+        piece = game.current_piece
+        columns['board'][i] = board
+        columns['current_shape_id'][i] = game.current_shape_id
+        columns['next_shape_id'][i] = game.next_shape_id
+        columns['rotation'][i] = piece.rotation
+        columns['origin_row'][i] = piece.origin_row
+        columns['origin_col'][i] = piece.origin_col
+        columns['action'][i] = action
+        return i
+
+    def end_record(self, i, game, rows_cleared):
+        columns = self.columns
+        columns['reward'][i] = rows_cleared
+        columns['holes'][i] = game.num_of_holes
+        columns['height'][i] = game.max_height_of_stacked_pieces
+        columns['game_over'][i] = not game.running_game
+
+    def attach(self, game):
+        # Hooks into step() and the lock of this game instance only, like
+        # Profiler.instrument(). Clones are not recorded, detach() removes
+        # the hooks.
+        if not (game.num_of_rows, game.num_of_columns) == (self.num_of_rows, self.num_of_columns):
+            raise ValueError("game board size does not match the recorder")
+        board = np.frombuffer(game.board.shape_ids, dtype=np.uint8).reshape(game.num_of_rows, game.num_of_columns)
+        step = game.step
+        lock = game.current_piece_has_reached_bottom
+        step_action = [NO_ACTION]
+
+        def recorded_step(action=tgame.ACTION_NONE, ticks=1):
+            rows_cleared = game.num_of_rows_cleared
+            if self.record_on == self.RECORD_STEPS:
+                i = self.begin_record(game, board, action)
+            step_action[0] = action
+            try:
+                result = step(action, ticks)
+            finally:
+                step_action[0] = NO_ACTION
+            if self.record_on == self.RECORD_STEPS:
+                self.end_record(i, game, game.num_of_rows_cleared - rows_cleared)
+            return result
+
+        def recorded_lock():
+            if self.record_on == self.RECORD_LOCKS:
+                i = self.begin_record(game, board, step_action[0])
+            cleared_rows = lock()
+            if self.record_on == self.RECORD_LOCKS:
+                self.end_record(i, game, len(cleared_rows))
+            return cleared_rows
+
+        game.step = recorded_step
+        game.current_piece_has_reached_bottom = recorded_lock
+
+    def detach(self, game):
+        for name in game.RECORDED_METHODS:
+            game.__dict__.pop(name, None)
+
+class ShardReader(object):
+    '''
+        Reads the records written by ShardRecorder. Shards are memory-mapped,
+        only the pages of the records read are loaded.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as index_file:
+            self.index = json.load(index_file)
+        self.counts = np.array([shard['count'] for shard in self.index['shards']], dtype=np.int64)
+        # Index of the first record of every shard.
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        self.shards = [None] * len(self.counts)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def get_shard(self, shard_index):
+        if self.shards[shard_index] is None:
+            path = os.path.join(self.directory, self.index['shards'][shard_index]['file'])
+            self.shards[shard_index] = np.load(path, mmap_mode='r')[:self.counts[shard_index]]
+        return self.shards[shard_index]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        shard_index = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.get_shard(shard_index)[i - self.starts[shard_index]]
+
+    def iter_batches(self, batch_size=4096):
+        # Yields the records in order as arrays of at most batch_size.
+        for shard_index in range(len(self.counts)):
+            shard = self.get_shard(shard_index)
+            for start in range(0, len(shard), batch_size):
+                yield np.array(shard[start:start + batch_size])
+
+    def sample(self, count, rng=None):
+        # count records drawn uniformly with replacement.
+        rng = np.random.default_rng() if rng is None else rng
+        indices = np.sort(rng.integers(0, len(self), size=count))
+        shard_indices = np.searchsorted(self.starts, indices, side='right') - 1
+        records = np.empty(count, dtype=get_record_dtype(self.index['num_of_rows'], self.index['num_of_columns']))
+        for shard_index in np.unique(shard_indices):
+            selected = shard_indices == shard_index
+            records[selected] = self.get_shard(shard_index)[indices[selected] - self.starts[shard_index]]
+        return records
+
+
+if __name__ == '__main__':
+    import sys
+    from sim_clock import SimulationClock
+    from ai_player import AIPlayer
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'training_data'
+    with ShardRecorder(directory, record_on=ShardRecorder.RECORD_LOCKS) as recorder:
+        player = AIPlayer()
+        for seed in range(10):
+            game = tgame(clock=SimulationClock(), seed=seed, verbose=False)
+            recorder.attach(game)
+            game.setup_new_game()
+            while game.running_game and game.num_of_pieces_placed < 200:
+                player.play_placement(game)
+    print(len(ShardReader(directory)), 'records in', directory)
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+class SimulationClock(object):
+    '''
+        Drop-in replacement for time.time() used by headless games. Time only
+        moves when advance() is called, in whole ticks, so a game driven by it
+        runs as fast as the CPU allows and replays identically.
+    '''
+    TICKS_PER_SEC = 60
+
+    def __init__(self, ticks_per_sec=TICKS_PER_SEC):
+        self.ticks_per_sec = ticks_per_sec
+        self.ticks = 0
+
+    def __call__(self):
+        return self.ticks / self.ticks_per_sec
+
+    def advance(self, ticks=1):
+        self.ticks += ticks
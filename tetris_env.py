@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from game import TetrisGame as tgame
+from sim_clock import SimulationClock
+
+class TetrisEnv(object):
+    '''
+        Gym style reinforcement learning environment around a headless
+        TetrisGame. reset() and step() return the same observation dict every
+        time, with NumPy views that are updated in place:
+
+            'board'  (rows, cols) uint8 view of the shape ids of the locked
+                     squares, SHAPE_ID_EMPTY where empty. Shares memory with
+                     the game board, nothing is copied per step.
+            'piece'  int32 [current shape id, rotation, origin row,
+                     origin col, next shape id]
+
+        Copy them to keep an observation past the next step.
+    '''
+    # Reward per cleared row, and penalties per new hole, per row of added
+    # height and for losing.
+    REWARD_ROW_CLEARED      = 1.0
+    PENALTY_HOLE            = 0.1
+    PENALTY_HEIGHT          = 0.05
+    PENALTY_GAME_OVER       = 1.0
+
+    NUM_OF_ACTIONS          = tgame.NUM_OF_ACTIONS
+    PIECE_FIELDS            = ('current_shape_id', 'rotation', 'origin_row', 'origin_col', 'next_shape_id')
+
+    def __init__(self, num_of_rows=20, num_of_columns=10, ticks_per_step=1, max_steps=0,
+                 reward_row_cleared=REWARD_ROW_CLEARED, penalty_hole=PENALTY_HOLE,
+                 penalty_height=PENALTY_HEIGHT, penalty_game_over=PENALTY_GAME_OVER):
+        self.game = tgame(num_of_rows, num_of_columns, clock=SimulationClock(), verbose=False)
+        self.ticks_per_step = ticks_per_step
+        # Episodes are cut after this many steps, 0 for no limit.
+        self.max_steps = max_steps
+        self.reward_row_cleared = reward_row_cleared
+        self.penalty_hole = penalty_hole
+        self.penalty_height = penalty_height
+        self.penalty_game_over = penalty_game_over
+        self.num_of_steps = 0
+
+        board = np.frombuffer(self.game.board.shape_ids, dtype=np.uint8).reshape(num_of_rows, num_of_columns)
+        board.flags.writeable = False
+        self.piece = np.zeros(len(self.PIECE_FIELDS), dtype=np.int32)
+        piece = self.piece.view()
+        piece.flags.writeable = False
+        self.observation = {'board': board, 'piece': piece}
+        self.observation_shapes = {'board': board.shape, 'piece': piece.shape}
+
+    def get_observation(self):
+        game = self.game
+        piece = game.current_piece
+        self.piece[0] = game.current_shape_id
+        self.piece[1] = piece.rotation
+        self.piece[2] = piece.origin_row
+        self.piece[3] = piece.origin_col
+        self.piece[4] = game.next_shape_id
+        return self.observation
+
+    def get_info(self):
+        game = self.game
+        return {'rows_cleared': game.num_of_rows_cleared,
+                'pieces_placed': game.num_of_pieces_placed,
+                'holes': game.num_of_holes,
+                'height': game.max_height_of_stacked_pieces,
+                'steps': self.num_of_steps}
+
+    def reset(self, seed=None):
+        self.game.setup_new_game(seed)
+        self.num_of_steps = 0
+        return self.get_observation()
+
+    def step(self, action):
+        # Returns (observation, reward, done, info).
+        game = self.game
+        rows_cleared = game.num_of_rows_cleared
+        holes = game.num_of_holes
+        height = game.max_height_of_stacked_pieces
+
+        game.step(int(action), self.ticks_per_step)
+        self.num_of_steps += 1
+
+        reward = self.reward_row_cleared * (game.num_of_rows_cleared - rows_cleared) \
+            - self.penalty_hole * (game.num_of_holes - holes) \
+            - self.penalty_height * (game.max_height_of_stacked_pieces - height)
+        done = not game.running_game
+        if done:
+            reward -= self.penalty_game_over
+        elif self.max_steps and self.num_of_steps >= self.max_steps:
+            done = True
+        return self.get_observation(), reward, done, self.get_info()
+
+
+if __name__ == '__main__':
+    env = TetrisEnv()
+    rng = np.random.default_rng(0)
+    observation = env.reset(seed=0)
+    done = False
+    total_reward = 0.0
+    while not done:
+        observation, reward, done, info = env.step(rng.integers(env.NUM_OF_ACTIONS))
+        total_reward += reward
+    print(total_reward, info)
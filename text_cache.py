@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import pygame as py
+from collections import OrderedDict
+
+class TextCache(object):
+    '''
+        Loads every font once and keeps rendered text surfaces, keyed on
+        (font, text, color), in a bounded LRU so static labels and unchanged
+        values are never rendered twice.
+    '''
+    FONT_FILE               = 'freesansbold.ttf'
+    DEFAULT_MAX_SURFACES    = 256
+
+    def __init__(self, font_file=FONT_FILE, max_surfaces=DEFAULT_MAX_SURFACES):
+        if max_surfaces <= 0:
+            raise ValueError(f"max_surfaces ({max_surfaces}) must be > 0")
+        self.font_file = font_file
+        self.max_surfaces = max_surfaces
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def get_font(self, font_size):
+        if font_size not in self.fonts:
+            self.fonts[font_size] = py.font.Font(self.font_file, font_size)
+        return self.fonts[font_size]
+
+    def render(self, text, font_size, color):
+        key = (font_size, text, color)
+        if key in self.surfaces:
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key]
+        surface = self.get_font(font_size).render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.fonts = {}
+        self.surfaces.clear()
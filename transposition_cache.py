@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+
+class TranspositionCache(object):
+    '''
+        Bounded LRU cache of evaluation results keyed on TetrisGame.zobrist_hash
+        (or any other hashable key). Counts hits and misses.
+    '''
+    DEFAULT_MAX_SIZE = 1 << 16
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        if max_size <= 0:
+            raise ValueError(f"max_size ({max_size}) must be > 0")
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import random as rand
+from pieces import TetrisPiece as tpiece
+
+class ZobristTable(object):
+    '''
+        Random 64 bit keys for every square of the board and for every current
+        and next shape. The hash of a board is the XOR of the keys of its
+        occupied squares, so locking a piece only XORs in four keys. Shape ids
+        of locked squares are left out, they do not change the game.
+    '''
+    SEED = 0x7E7815
+
+    def __init__(self, num_of_rows=20, num_of_columns=10, seed=SEED):
+        rng = rand.Random(seed)
+        self.num_of_rows = num_of_rows
+        self.num_of_columns = num_of_columns
+        self.square_keys = [[rng.getrandbits(64) for col in range(num_of_columns)] for row in range(num_of_rows)]
+        self.current_shape_keys = [rng.getrandbits(64) for shape_id in range(tpiece.SHAPE_ID_EMPTY + 1)]
+        self.next_shape_keys = [rng.getrandbits(64) for shape_id in range(tpiece.SHAPE_ID_EMPTY + 1)]
+
+    def hash_cells(self, cells):
+        result = 0
+        for row, col in cells:
+            result ^= self.square_keys[row][col]
+        return result
+
+    def hash_rows(self, masks, first_row, last_row):
+        result = 0
+        for row in range(first_row, last_row + 1):
+            row_mask = masks[row]
+            keys = self.square_keys[row]
+            col = 0
+            while row_mask:
+                if row_mask & 1:
+                    result ^= keys[col]
+                row_mask >>= 1
+                col += 1
+        return result
+
+    def hash_shapes(self, current_shape_id, next_shape_id):
+        return self.current_shape_keys[current_shape_id] ^ self.next_shape_keys[next_shape_id]
+
+
+zobrist_tables = {}
+
+def get_zobrist_table(num_of_rows, num_of_columns):
+    # One shared table per board size, so hashes from different games of the
+    # same size can be compared.
+    key = (num_of_rows, num_of_columns)
+    if key not in zobrist_tables:
+        zobrist_tables[key] = ZobristTable(num_of_rows, num_of_columns)
+    return zobrist_tables[key]